@@ -1,18 +1,45 @@
+import hashlib
+import json
 import logging
 import os
+from typing import Dict, List, Tuple
 
 import click
 import yaml
 from jinja2 import Environment, FileSystemLoader, select_autoescape, Template
 
+# Operating systems (as named by the agent) the templates handle
+OPERATING_SYSTEMS = ["debian", "macOS", "windows", "manjaro"]
 
-def write_to_template(template: Template, system_name: str, file_name: str, **kwargs):
-    content = template.render(**kwargs)
+
+def parse_version(version: str | Dict, default_operating_systems: List[str]) -> Tuple[str, List[str]]:
+    """A version is either just the version or `{version: ..., operating_systems: [...]}`."""
+    if isinstance(version, dict):
+        return str(version["version"]), version.get("operating_systems", default_operating_systems)
+    return str(version), default_operating_systems
+
+
+def write_to_template(template: Template, system_name: str, file_name: str, **kwargs) -> Dict:
+    """Returns the manifest entry of the playbook."""
+    content = template.render(**kwargs).encode("utf-8")
     service_dir = f"ansible/playbooks/{system_name}"
     if not os.path.isdir(service_dir):
         os.makedirs(service_dir)
-    with open(f"ansible/playbooks/{system_name}/{file_name}.yml", "w") as stream:
+    path = f"{system_name}/{file_name}.yml"
+    with open(f"ansible/playbooks/{path}", "wb") as stream:
         stream.write(content)
+    return {
+        "service": system_name,
+        "version": file_name,
+        "path": path,
+        "sha256": hashlib.sha256(content).hexdigest(),
+        "size": len(content)
+    }
+
+
+def write_manifest(entries: List[Dict]):
+    with open("ansible/playbooks/manifest.json", "w") as stream:
+        json.dump({"playbooks": entries}, stream, indent=2)
 
 
 @click.command("generate")
@@ -24,6 +51,7 @@ def generate_playbooks(config: str, verbose: bool):
         configuration = yaml.safe_load(stream)
     services = configuration["services"]
     version_counter = 0
+    manifest = []
     for service in services:
         name = service["system_name"]
         versions = service["versions"]
@@ -35,11 +63,24 @@ def generate_playbooks(config: str, verbose: bool):
         env = Environment(loader=FileSystemLoader("ansible/templates"),
                           autoescape=select_autoescape())
         template = env.get_template(template_file)
+        default_operating_systems = service.get("operating_systems", OPERATING_SYSTEMS)
+        all_operating_systems = {}  # ordered set
         for version in versions:
+            version, operating_systems = parse_version(version, default_operating_systems)
             logging.debug("Generated playbook for %s version %s", name, version)
-            write_to_template(template, name, version, version=version, state="present", **data)
+            entry = write_to_template(template, name, version, version=version, state="present",
+                                      **data)
+            # Versions are listed newest first for each operating system
+            latest_for = [os_name for os_name in operating_systems
+                          if os_name not in all_operating_systems]
+            all_operating_systems.update(dict.fromkeys(operating_systems))
+            manifest.append({**entry, "operating_systems": operating_systems,
+                             "latest_for": latest_for})
             version_counter += 1
-        write_to_template(template, name, "uninstall", version=None, state="absent", **data)
+        entry = write_to_template(template, name, "uninstall", version=None, state="absent", **data)
+        manifest.append({**entry, "operating_systems": list(all_operating_systems),
+                         "latest_for": []})
+    write_manifest(manifest)
     logging.info("Generated playbooks for %s service(s) across %s versions (%s files total)",
                  len(services), version_counter, version_counter + len(services))
 
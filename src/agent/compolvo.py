@@ -1,26 +1,77 @@
 import asyncio
 import enum
+import hashlib
 import json
 import logging
 import os
 import platform
-import queue
+import random
 import sys
+import threading
+from collections import deque, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from logging import Logger
-from threading import Thread
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Deque, Set, List, Callable
 
 import click
 import distro
 import requests
 import websockets
 import yaml
-from websockets.exceptions import ConnectionClosedError
+
+try:
+    import msgpack
+except ImportError:  # optional, the server is asked for JSON then
+    msgpack = None
 
 config: "Config"
 logger: Logger
 config_filename: str
-message_queue = queue.Queue()
+# Messages for the server, kept across reconnects
+outgoing_messages: asyncio.Queue[Dict] = asyncio.Queue()
+unsent_messages: Deque[Dict] = deque()
+# Shared so that connections to the server are kept alive
+session = requests.Session()
+playbook_cache: "PlaybookCache"
+_command_tasks: Set[asyncio.Task] = set()
+
+# Short codes for the field names of the notify protocol, used by the compact encoding. Must be
+# kept in sync with the server (compolvo/codec.py).
+FIELD_CODES = {
+    "event": "e",
+    "type": "t",
+    "recipient": "r",
+    "message": "m",
+    "ephemeral": "x",
+    "subscriber_type": "st",
+    "subscriber": "sr",
+    "subscription": "sn",
+    "event_type": "et",
+    "id": "i",
+    "sub_id": "si",
+    "intent": "in",
+    "success": "s",
+    "error": "er",
+    "agent_id": "a",
+    "service": "sv",
+    "software": "sw",
+    "software_id": "sid",
+    "version": "v",
+    "status": "ss",
+    "installed_version": "iv",
+    "corrupt": "c",
+    "installing": "ig",
+    "uninstalling": "ug",
+    "sha256": "h",
+    "command": "cm",
+}
+FIELD_NAMES = {code: name for name, code in FIELD_CODES.items()}
+# Prepended to keys of the payload that look like a code, so that decoding doesn't rename them
+ESCAPE = "~"
+COMPACT_ENCODING = "msgpack-v1"
+ENCODINGS = [COMPACT_ENCODING, "json"] if msgpack is not None else ["json"]
+# Negotiated during login
+wire_encoding = "json"
 
 
 class ConfigAgent:
@@ -78,9 +129,9 @@ def save_config(config: Config, config_file: str):
         yaml.safe_dump(config.to_dict(), f)
 
 
-def install_software(event: Dict) -> str | None:
+def install_software(event: Dict) -> Dict | None:
     system_name, software_id, version = extract_command_data_from_event(event)
-    return run_playbook(system_name, software_id, version)
+    return run_playbook(system_name, software_id, version, event["message"].get("sha256"))
 
 
 def extract_command_data_from_event(event: Dict):
@@ -91,13 +142,51 @@ def extract_command_data_from_event(event: Dict):
     return system_name, software_id, version
 
 
-def uninstall_software(event: Dict) -> str | None:
+def uninstall_software(event: Dict) -> Dict | None:
     system_name, software_id, _ = extract_command_data_from_event(event)
-    return run_playbook(system_name, software_id, "uninstall")
+    return run_playbook(system_name, software_id, "uninstall", event["message"].get("sha256"))
+
+
+def _encode_key(key: Any) -> Any:
+    if key in FIELD_CODES:
+        return FIELD_CODES[key]
+    if isinstance(key, str) and (key in FIELD_NAMES or key.startswith(ESCAPE)):
+        return ESCAPE + key
+    return key
+
+
+def _decode_key(key: Any) -> Any:
+    if isinstance(key, str) and key.startswith(ESCAPE):
+        return key[len(ESCAPE):]
+    return FIELD_NAMES.get(key, key)
+
+
+def _rename_fields(obj: Any, rename_key: Callable[[Any], Any]) -> Any:
+    if isinstance(obj, dict):
+        return {rename_key(key): _rename_fields(value, rename_key) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [_rename_fields(value, rename_key) for value in obj]
+    return obj
 
 
-def handle_websocket_command(command: str) -> str | None:
-    data = json.loads(command)
+def encode_message(data: Dict | str | bytes) -> str | bytes:
+    if isinstance(data, (str, bytes)):  # already encoded
+        return data
+    if wire_encoding == COMPACT_ENCODING:
+        return msgpack.packb(_rename_fields(data, _encode_key))
+    return json.dumps(data)
+
+
+def decode_message(data: str | bytes) -> Dict:
+    # Text frames are always JSON
+    if isinstance(data, bytes) and wire_encoding == COMPACT_ENCODING:
+        return _rename_fields(msgpack.unpackb(data), _decode_key)
+    return json.loads(data)
+
+
+def parse_command(command: str | bytes) -> Dict | None:
+    """Returns the event if the message is a command for this agent."""
+    data = decode_message(command)
     event = data.get("event")
     if data.get("success") == True:
         logger.debug("Received positive confirmation: %s", data)
@@ -105,31 +194,66 @@ def handle_websocket_command(command: str) -> str | None:
     if event is None:
         logger.warning("Received websocket message that can't be interpreted: %s", data)
         return
-    if event.get("type") == "software-status-update":
-        return
     recipient = event.get("recipient", {})
+    if recipient.get("subscriber_type") == "server":
+        # Echo of an event sent by this agent
+        return
     assert recipient.get(
         "subscriber_type") == "agent", f"Received event for {recipient}: {event} (expected for agent)."
     recipient_id = recipient.get("id")
     assert recipient_id is None or recipient_id == config.agent.id, f"Received event for different agent: {event}"
-    type = event["type"]
-    msg: str | None = None
-    match type:
+    if event["type"] not in ("install-software", "uninstall-software"):
+        logger.error("Received unsupported event of type '%s': %s", event["type"], event)
+        return None
+    return event
+
+
+def execute_command(event: Dict) -> Dict | None:
+    """Runs in a worker thread, returns the message to send back to the server."""
+    match event["type"]:
         case "install-software":
-            msg = install_software(event)
+            return install_software(event)
         case "uninstall-software":
-            msg = uninstall_software(event)
-        case other:
-            logger.error("Received unsupported event of type '%s': %s", other, event)
-    if msg is not None:
-        logger.debug("Queueing message: %s", msg)
-        message_queue.put(msg)
+            return uninstall_software(event)
     return None
 
 
+class CommandScheduler:
+    """Runs commands on a bounded thread pool. Commands for the same service run one after
+    another, and a command that hasn't started yet is superseded by a newer one for the same
+    software."""
+    _locks: Dict[str, asyncio.Lock]
+    _pending: Dict[str, Dict]
+
+    def __init__(self, concurrency: int):
+        self._executor = ThreadPoolExecutor(concurrency, thread_name_prefix="command")
+        self._locks = defaultdict(asyncio.Lock)
+        self._pending = {}  # software id -> newest command that hasn't started yet
+
+    async def submit(self, event: Dict):
+        system_name, software_id, _ = extract_command_data_from_event(event)
+        superseded = self._pending.get(software_id)
+        self._pending[software_id] = event
+        if superseded is not None:
+            # The task waiting for the superseded command runs this one instead
+            logger.info("Skipping %s of %s, superseded by %s", superseded["type"], system_name,
+                        event["type"])
+            await outgoing_messages.put(
+                answering(generate_software_acknowledgement(software_id), superseded))
+            return
+        async with self._locks[system_name]:
+            event = self._pending.pop(software_id)
+            msg = await asyncio.get_running_loop().run_in_executor(self._executor,
+                                                                   execute_command, event)
+        if msg is not None:
+            msg = answering(msg, event)
+            logger.debug("Queueing message: %s", msg)
+            await outgoing_messages.put(msg)
+
+
 def generate_software_status(software_id: str, installed_version: str | None, corrupt=False,
-                             installing=False, uninstalling=False):
-    return json.dumps({
+                             installing=False, uninstalling=False) -> Dict:
+    return {
         "event": {
             "type": "software-status-update",
             "recipient": {
@@ -146,46 +270,239 @@ def generate_software_status(software_id: str, installed_version: str | None, co
                 }
             }
         }
-    })
+    }
+
+
+def generate_software_acknowledgement(software_id: str) -> Dict:
+    """Status update without any changes, acknowledges a command that has been skipped."""
+    status = generate_software_status(software_id, None)
+    status["event"]["message"]["status"] = {}
+    return status
 
 
-def run_playbook(system_name: str, software_id: str, playbook_name: str):
-    playbook_url = f"http{'s' if config.compolvo.secure else ''}://{config.compolvo.host}/ansible/playbooks/{system_name}/{playbook_name}.yml"
-    response = requests.get(playbook_url)
-    if not response.ok:
-        logger.error("Error fetching playbook from %s: %s", playbook_url, response.text)
+def answering(status: Dict, command: Dict) -> Dict:
+    """Echoes the id of the command `status` answers, so that the server acknowledges exactly that
+    command."""
+    command_id = command["message"].get("command")
+    if command_id is not None:
+        status["event"]["message"]["command"] = command_id
+    return status
+
+
+class PlaybookMismatch(Exception):
+    pass
+
+
+class PlaybookCache:
+    """Content-addressed cache of playbooks on disk. Files are stored under their SHA-256 and
+    revalidated with the ETag/Last-Modified the server sent for them, so unchanged playbooks are
+    never downloaded twice."""
+    directory: str
+    _index: Dict[str, Dict[str, str | None]]
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._index_path = os.path.join(directory, "index.json")
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(directory, "objects"), exist_ok=True)
+        try:
+            with open(self._index_path, "r") as f:
+                self._index = json.load(f)  # url -> sha256, etag, last_modified
+        except (FileNotFoundError, json.JSONDecodeError):
+            self._index = {}
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self.directory, "objects", digest + ".yml")
+
+    def _write_atomically(self, path: str, content: bytes):
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def _cached_entry(self, url: str) -> Dict[str, str | None] | None:
+        with self._lock:
+            entry = self._index.get(url)
+        if entry is None or not os.path.exists(self._object_path(entry["sha256"])):
+            return None
+        return entry
+
+    def get(self, url: str, sha256: str | None = None) -> str:
+        """Returns the path of the playbook on disk, downloading or revalidating it first. A known
+        `sha256` skips revalidation if the cached content matches and is verified otherwise."""
+        entry = self._cached_entry(url)
+        if entry is not None and sha256 is not None and entry["sha256"] == sha256:
+            return self._object_path(entry["sha256"])
+        path = self._fetch(url, entry)
+        if sha256 is not None and not path.endswith(sha256 + ".yml"):
+            # The cache might be stale even though the server said otherwise, ask for all of it
+            path = self._fetch(url, None)
+            if not path.endswith(sha256 + ".yml"):
+                raise PlaybookMismatch(f"Playbook {url} doesn't match its SHA-256 {sha256}")
+        return path
+
+    def _fetch(self, url: str, entry: Dict[str, str | None] | None) -> str:
+        headers = {}
+        if entry is not None:
+            if entry.get("etag") is not None:
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified") is not None:
+                headers["If-Modified-Since"] = entry["last_modified"]
+        try:
+            response = session.get(url, headers=headers, timeout=30)
+        except requests.ConnectionError:
+            if entry is None:
+                raise
+            logger.warning("Can't revalidate %s, using cached playbook", url)
+            return self._object_path(entry["sha256"])
+        if response.status_code == 304 and entry is not None:
+            logger.debug("Playbook %s not modified", url)
+            return self._object_path(entry["sha256"])
+        response.raise_for_status()
+        digest = hashlib.sha256(response.content).hexdigest()
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            self._write_atomically(path, response.content)
+        with self._lock:
+            self._index[url] = {
+                "sha256": digest,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified")
+            }
+            self._write_atomically(self._index_path, json.dumps(self._index).encode("utf-8"))
+        return path
+
+
+def compolvo_url(path: str) -> str:
+    return f"http{'s' if config.compolvo.secure else ''}://{config.compolvo.host}{path}"
+
+
+def prewarm_playbook_cache():
+    """Downloads the playbooks of the latest versions for this operating system advertised in the
+    manifest, so installs don't have to wait for them."""
+    try:
+        operating_system = detect_operating_system().value
+    except UnsupportedOperatingSystem:
+        return
+    try:
+        response = session.get(compolvo_url("/ansible/playbooks/manifest.json"), timeout=30)
+        if response.status_code == 404:
+            logger.debug("No playbook manifest available")
+            return
+        response.raise_for_status()
+        entries = [entry for entry in response.json().get("playbooks", []) if
+                   operating_system in entry.get("latest_for", [])]
+    except (requests.RequestException, ValueError) as e:
+        logger.warning("Couldn't load playbook manifest: %s", e)
+        return
+    for entry in entries:
+        try:
+            playbook_cache.get(compolvo_url("/ansible/playbooks/" + entry["path"]),
+                               entry.get("sha256"))
+        except (requests.RequestException, PlaybookMismatch) as e:
+            logger.warning("Couldn't prefetch playbook %s: %s", entry["path"], e)
+    logger.info("Prefetched %s playbook(s)", len(entries))
+
+
+def run_playbook(system_name: str, software_id: str, playbook_name: str, sha256: str | None = None):
+    playbook_url = compolvo_url(f"/ansible/playbooks/{system_name}/{playbook_name}.yml")
+    try:
+        path = playbook_cache.get(playbook_url, sha256)
+    except (requests.RequestException, PlaybookMismatch) as e:
+        logger.error("Error fetching playbook from %s: %s", playbook_url, e)
         return generate_software_status(software_id, None, True, False, False)
-    path = system_name + ".yml"
-    with open(path, "w") as f:
-        f.write(response.text)
     return_code = os.system(f"ansible-playbook '{path}'")
-    os.remove(path)
     installed_version = playbook_name if playbook_name != 'uninstall' else None
     if return_code == 0:
         return generate_software_status(software_id, installed_version, False, False, False)
     return generate_software_status(software_id, installed_version, True, False, False)
 
 
-async def subscribe(ws: websockets.WebSocketClientProtocol, event_type: str):
-    subscription_data = {
-        "intent": "subscribe",
-        "subscriber_type": "agent",
-        "event_type": event_type,
-        "id": config.agent.id
-    }
-    await ws.send(json.dumps(subscription_data))
-    response = await ws.recv()
-    res = json.loads(response)
-    if not res.get("success", False):
-        raise Exception("Received unsuccessful message from server: " + response)
+async def subscribe(ws: websockets.WebSocketClientProtocol, scheduler: CommandScheduler,
+                    event_types: List[str]):
+    """Subscribes to all `event_types` and waits for the confirmations. Commands that arrive in the
+    meantime, e.g. replayed ones, are run as usual."""
+    for event_type in event_types:
+        subscription_data = {
+            "intent": "subscribe",
+            "subscriber_type": "agent",
+            "event_type": event_type,
+            "id": config.agent.id
+        }
+        await ws.send(encode_message(subscription_data))
+    unconfirmed = set(event_types)
+    while len(unconfirmed) > 0:
+        data = await ws.recv()
+        res = decode_message(data)
+        subscription = res.get("subscription")
+        if subscription is not None:
+            unconfirmed.discard(subscription["subscriber"]["event_type"])
+        elif res.get("success") == False:
+            raise Exception("Received unsuccessful message from server: " + str(res))
+        else:
+            handle_message(data, scheduler)
+
+
+async def run_command(scheduler: CommandScheduler, event: Dict):
+    try:
+        await scheduler.submit(event)
+    except Exception as e:
+        handle_error_for_user(e)
 
 
-async def run_websocket(retries: Optional[int] = 5):
+def handle_message(data: str | bytes, scheduler: CommandScheduler):
+    logger.debug("received %s", data)
+    try:
+        event = parse_command(data)
+    except (AssertionError, ValueError, KeyError) as e:
+        handle_error_for_user(e)
+        return
+    if event is None:
+        return
+    # Commands keep running when the connection is lost, their results are sent on the next one
+    task = asyncio.create_task(run_command(scheduler, event))
+    _command_tasks.add(task)
+    task.add_done_callback(_command_tasks.discard)
+
+
+async def receive_messages(ws: websockets.WebSocketClientProtocol, scheduler: CommandScheduler):
+    async for data in ws:
+        handle_message(data, scheduler)
+
+
+async def send_messages(ws: websockets.WebSocketClientProtocol):
+    while True:
+        msg = unsent_messages.popleft() if len(unsent_messages) > 0 else \
+            await outgoing_messages.get()
+        try:
+            logger.debug("Sending %s", msg)
+            await ws.send(encode_message(msg))
+        except BaseException:
+            unsent_messages.appendleft(msg)
+            raise
+
+
+async def run_connection(ws: websockets.WebSocketClientProtocol, scheduler: CommandScheduler):
+    receiver = asyncio.create_task(receive_messages(ws, scheduler))
+    sender = asyncio.create_task(send_messages(ws))
+    done, pending = await asyncio.wait({receiver, sender}, return_when=asyncio.FIRST_COMPLETED)
+    for task in pending:
+        task.cancel()
+    for task in done:
+        task.result()  # raises the error that ended the connection
+    logger.info("Connection closed by server.")
+
+
+async def run_websocket(retries: Optional[int] = 5, concurrency: int = 1):
+    global wire_encoding
+    scheduler = CommandScheduler(concurrency)
+    asyncio.get_running_loop().run_in_executor(None, prewarm_playbook_cache)
     uri = f"ws{'s' if config.compolvo.secure else ''}://{config.compolvo.host}/api/notify"
     logger.debug("logging in to WebSocket at %s", uri)
     while retries is None or retries > 0:
         try:
-            async with websockets.connect(uri) as ws:
+            async with websockets.connect(uri, compression="deflate") as ws:
+                wire_encoding = "json"
                 login_data = {
                     "event": {
                         "type": "agent-login",
@@ -194,7 +511,8 @@ async def run_websocket(retries: Optional[int] = 5):
                             "id": None
                         },
                         "message": {
-                            "agent_id": config.agent.id
+                            "agent_id": config.agent.id,
+                            "encodings": ENCODINGS
                         }
                     }
                 }
@@ -202,35 +520,19 @@ async def run_websocket(retries: Optional[int] = 5):
                 response = await ws.recv()
                 res = json.loads(response)
                 if res.get("success", False):
-                    logger.info("Logged in successfully.")
+                    wire_encoding = res.get("encoding", "json")
+                    logger.info("Logged in successfully, using %s encoding.", wire_encoding)
                 else:
                     logger.info("Error logging in: %s", response)
-                _ = await ws.recv()
-                await subscribe(ws, "install-software")
-                await subscribe(ws, "uninstall-software")
+                    retry_after = res.get("retry_after")
+                    if retry_after is not None:
+                        # Server is busy, come back when it suggests instead of counting a retry
+                        await asyncio.sleep(float(retry_after))
+                        continue
+                await subscribe(ws, scheduler, ["install-software", "uninstall-software"])
                 logger.info("Subscribed to relevant notification topics.")
                 try:
-                    while True:
-                        data: str | bytes | None = None
-                        if ws.closed:
-                            raise ConnectionClosedError(ws.close_rcvd, ws.close_sent)
-                        try:
-                            async with asyncio.timeout(1):
-                                data = await ws.recv()
-                                logger.debug("received %s", data)
-                        except asyncio.TimeoutError:
-                            pass
-                        try:
-                            if data is not None:
-                                Thread(target=handle_websocket_command, args=(data,)).start()
-                            while message_queue.unfinished_tasks > 0:
-                                msg = message_queue.get()
-                                logger.debug("Sending %s", msg)
-                                await ws.send(msg)
-                                message_queue.task_done()
-                        except (AssertionError, ConnectionClosedError) as e:
-                            handle_error_for_user(e)
-                            message_queue.put(data)
+                    await run_connection(ws, scheduler)
                 except KeyboardInterrupt:
                     return
                 except Exception as e:
@@ -239,7 +541,8 @@ async def run_websocket(retries: Optional[int] = 5):
             handle_error_for_user(e)
             if retries is not None:
                 retries = retries - 1
-        await asyncio.sleep(1)
+        # Jitter so that agents don't reconnect in lockstep after a server restart
+        await asyncio.sleep(1 + random.random())
 
 
 def handle_error_for_user(err: Exception):
@@ -340,8 +643,16 @@ def init(compolvo_host: str, agent_id: str, overwrite: bool, insecure: bool):
 @click.command("run")
 @click.option("--infinite-retries", "-r", is_flag=True, default=False,
               help="Infinite retries when connection fails (default 5)")
-def run(infinite_retries: bool):
-    args = {}
+@click.option("--concurrency", "-j", type=click.IntRange(min=1), default=1,
+              help="Number of playbooks to run at the same time (default 1)")
+@click.option("--cache-dir", default=None,
+              help="Directory to cache playbooks in (default: playbook-cache next to the config file)")
+def run(infinite_retries: bool, concurrency: int, cache_dir: str | None):
+    global playbook_cache
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(config_filename)), "playbook-cache")
+    playbook_cache = PlaybookCache(cache_dir)
+    args = {"concurrency": concurrency}
     if infinite_retries:
         args["retries"] = None
     asyncio.run(run_websocket(**args))
@@ -0,0 +1,67 @@
+"""Time and query count of the /api/service catalog at 10, 100 and 1000 services.
+
+Run from src/server: python -m benchmarks.catalog
+"""
+from tortoise import Tortoise
+
+from benchmarks.common import run, measure, count_queries, init_db
+from compolvo.catalog import build_service_catalog
+from compolvo.models import License, OperatingSystem, PackageManager, \
+    PackageManagerAvailableVersion, Service, ServiceOffering, Tag
+
+
+async def legacy_catalog(services):
+    # The per-service expansion used by get_services before the catalog builder
+    async def expand(svc: Service) -> dict:
+        # one query per service, like the Coalesce annotation (which sqlite doesn't support)
+        query = PackageManagerAvailableVersion.filter(service_id=svc.id).values("operating_system_id")
+        oses = [str(os.get("operating_system_id")) for os in await query]
+        return {
+            **await svc.to_dict(),
+            "tags": [await tag.to_dict() for tag in await svc.tags],
+            "offerings": [await offering.to_dict() for offering in
+                          await ServiceOffering.filter(service=svc).order_by(
+                              "duration_days").all()],
+            "operating_systems": oses,
+        }
+
+    return [await expand(svc) for svc in services]
+
+
+async def populate(count: int):
+    license = await License.create(name="MIT")
+    tags = [await Tag.create(label=label) for label in ("Developer", "Enthusiast")]
+    oses = [await OperatingSystem.create(name=name, system_name=name)
+            for name in ("debian", "windows", "macOS")]
+    package_manager = await PackageManager.create(name="apt")
+    await Service.bulk_create([Service(name=f"Service {i}", system_name=f"service-{i}",
+                                       license=license, download_count=i) for i in range(count)])
+    services = await Service.all()
+    for service in services:
+        await service.tags.add(*tags)
+    await ServiceOffering.bulk_create(
+        [ServiceOffering(name=name, service=service, price=9.99, duration_days=days)
+         for service in services for name, days in (("month", 30), ("year", 360))])
+    await PackageManagerAvailableVersion.bulk_create(
+        [PackageManagerAvailableVersion(service=service, operating_system=os,
+                                        package_manager=package_manager, version="1.0",
+                                        latest=True)
+         for service in services for os in oses])
+
+
+async def main():
+    for count in (10, 100, 1000):
+        await Tortoise.close_connections()
+        await init_db()
+        await populate(count)
+        services = await Service.all()
+        before_queries = await count_queries(lambda: legacy_catalog(services))
+        after_queries = await count_queries(lambda: build_service_catalog(services))
+        before = await measure(lambda: legacy_catalog(services), rounds=1)
+        after = await measure(lambda: build_service_catalog(services))
+        print(f"{count:>5} services  before: {before * 1000:>8.1f} ms {before_queries:>5} queries  "
+              f"after: {after * 1000:>8.1f} ms {after_queries:>5} queries")
+
+
+if __name__ == "__main__":
+    run(main)
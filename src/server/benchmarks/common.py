@@ -0,0 +1,60 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Coroutine
+
+from tortoise import Tortoise
+
+
+async def init_db():
+    await Tortoise.init(db_url="sqlite://:memory:", modules={"models": ["compolvo.models"]})
+    await Tortoise.generate_schemas()
+
+
+def run(main: Callable[[], Coroutine]):
+    async def wrapper():
+        await init_db()
+        try:
+            await main()
+        finally:
+            await Tortoise.close_connections()
+
+    asyncio.run(wrapper())
+
+
+async def measure(func: Callable[[], Awaitable], rounds: int = 3) -> float:
+    """Return the best wall-clock time in seconds over `rounds` runs."""
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        await func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+class QueryCounter(logging.Handler):
+    """Counts the queries Tortoise logs while it is installed."""
+
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.count = 0
+        self._logger = logging.getLogger("tortoise.db_client")
+
+    def emit(self, record: logging.LogRecord):
+        self.count += 1
+
+    def __enter__(self):
+        self._level = self._logger.level
+        self._logger.setLevel(logging.DEBUG)
+        self._logger.addHandler(self)
+        return self
+
+    def __exit__(self, *exc):
+        self._logger.removeHandler(self)
+        self._logger.setLevel(self._level)
+
+
+async def count_queries(func: Callable[[], Awaitable]) -> int:
+    with QueryCounter() as counter:
+        await func()
+    return counter.count
@@ -0,0 +1,79 @@
+"""Rows/sec of the model serializer for Agent and AgentSoftware lists.
+
+Both sides emit the stored foreign key ids without queries, so only the compiled serializer plans
+are measured against the isinstance chain they replaced. "verified" is the default `list_dict`,
+which additionally checks the referenced rows exist with one query per related model.
+
+Run from src/server: python -m benchmarks.serialization [rows]
+"""
+import datetime
+import sys
+from uuid import UUID
+
+import tortoise.queryset
+from tortoise.fields.relational import _NoneAwaitable
+
+from benchmarks.common import run, measure
+from compolvo.models import Agent, AgentSoftware, BillingCycle, BillingCycleType, License, \
+    OperatingSystem, Serializable, Service, ServiceOffering, ServicePlan, User
+
+
+async def legacy_to_dict(obj: Serializable):
+    # The isinstance chain used before the serializer plans, reading foreign keys from the stored
+    # `<field>_id` instead of querying them
+    data = {}
+    for field in obj.fields:
+        value = getattr(obj, field)
+        if isinstance(value, UUID):
+            value = str(value)
+        elif isinstance(value, datetime.datetime):
+            value = value.isoformat()
+        elif isinstance(value, tortoise.queryset.QuerySet):
+            value = getattr(obj, f"{field}_id")
+            value = str(value) if value is not None else None
+        elif isinstance(value, Serializable):
+            value = await value.to_dict()
+        elif isinstance(value, _NoneAwaitable):
+            value = None
+        data[field] = value
+    return data
+
+
+async def populate(rows: int):
+    cycle = await BillingCycle.create(type=BillingCycleType.INDIVIDUAL, description="Individual")
+    user = await User.create(email="benchmark@example.com", billing_cycle=cycle)
+    os = await OperatingSystem.create(name="Debian", system_name="debian")
+    license = await License.create(name="MIT")
+    service = await Service.create(name="Nginx", system_name="nginx", license=license)
+    offering = await ServiceOffering.create(name="month", service=service, price=9.99,
+                                            duration_days=30)
+    plan = await ServicePlan.create(service_offering=offering, user=user,
+                                    start_date=datetime.datetime.now(tz=datetime.timezone.utc))
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    agents = [Agent(user=user, name=f"agent-{i}", operating_system=os, last_connection_start=now)
+              for i in range(rows)]
+    await Agent.bulk_create(agents)
+    await AgentSoftware.bulk_create(
+        [AgentSoftware(agent=agent, service_plan=plan, last_updated=now)
+         for agent in await Agent.all()])
+
+
+async def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    await populate(rows)
+    for cls in (Agent, AgentSoftware):
+        objects = await cls.all()
+        before = await measure(lambda: legacy_list_dict(objects))
+        after = await measure(lambda: Serializable.list_dict(objects, verify_foreign_keys=False))
+        verified = await measure(lambda: Serializable.list_dict(objects))
+        print(f"{cls.__name__:<14} {rows} rows  before: {rows / before:>10.0f} rows/s  "
+              f"after: {rows / after:>10.0f} rows/s  ({before / after:.1f}x)  "
+              f"verified: {rows / verified:>10.0f} rows/s")
+
+
+async def legacy_list_dict(objects):
+    return [await legacy_to_dict(obj) for obj in objects]
+
+
+if __name__ == "__main__":
+    run(main)
@@ -0,0 +1,143 @@
+"""Checks several local worker processes sharing a UnixSocketBus, as the server runs them with
+SERVER_WORKERS > 1: events published by every worker reach the subscribers in the hub, and a write
+in one worker invalidates the catalog cache of all others. Reports how long that takes.
+
+Run from src/server: python -m benchmarks.workers [workers]
+"""
+import asyncio
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+from tortoise import Tortoise
+
+from compolvo import notify
+from compolvo.bus import UnixSocketBus
+from compolvo.catalog import catalog_cache
+from compolvo.models import License, Service
+from compolvo.notify import Event, EventType, Recipient, SubscriberType
+
+EVENTS_PER_WORKER = 200
+TIMEOUT = 10
+
+
+def db_url(directory: str) -> str:
+    return f"sqlite://{os.path.join(directory, 'db.sqlite3')}"
+
+
+async def wait_for(condition, timeout: float = TIMEOUT) -> bool:
+    """Polls `condition`, which may be a coroutine function, until it's true or `timeout` passed."""
+    deadline = time.monotonic() + timeout
+    while not await _evaluate(condition):
+        if time.monotonic() > deadline:
+            return False
+        await asyncio.sleep(0.001)
+    return True
+
+
+async def _evaluate(condition) -> bool:
+    result = condition()
+    return await result if asyncio.iscoroutine(result) else result
+
+
+async def catalog_contains(name: str) -> bool:
+    body, _ = await catalog_cache.get()
+    return f'"{name}"'.encode("utf-8") in body
+
+
+async def worker_main(index: int, workers: int, directory: str, barrier, written_at, results):
+    await Tortoise.init(db_url=db_url(directory), modules={"models": ["compolvo.models"]})
+    bus = UnixSocketBus(os.path.join(directory, "bus.sock"))
+    notify.set_bus(bus)
+    notify.register_cache("catalog", catalog_cache.invalidate)
+    received = []
+
+    async def handler(event: Event):
+        received.append(event)
+
+    notify.subscribe(SubscriberType.USER, EventType.RELOAD, handler, "benchmark")
+    bus_task = asyncio.create_task(bus.run(lambda: notify.run_queue_worker(1)))
+    loop = asyncio.get_running_loop()
+    failures = []
+    latencies = []
+    try:
+        if not await wait_for(lambda: bus.is_hub or bus._writer is not None):
+            failures.append("never connected to the bus")
+        await loop.run_in_executor(None, barrier.wait)
+        recipient = Recipient(SubscriberType.USER, "benchmark")
+        notify.queue_many(Event(EventType.RELOAD, recipient, {"worker": index, "n": i})
+                          for i in range(EVENTS_PER_WORKER))
+        await catalog_cache.get()
+        for writer in range(workers):
+            await loop.run_in_executor(None, barrier.wait)
+            name = f"service-of-worker-{writer}"
+            if writer == index:
+                await Service.create(name=name, system_name=name,
+                                     license=await License.first())
+                written_at.value = time.perf_counter()
+                notify.invalidate_cache("catalog")
+            elif await wait_for(lambda: catalog_contains(name)):
+                latencies.append(time.perf_counter() - written_at.value)
+            else:
+                failures.append(f"stale catalog, missing {name}")
+        if bus.is_hub:
+            expected = workers * EVENTS_PER_WORKER
+            if not await wait_for(lambda: len(received) >= expected):
+                failures.append(f"hub received {len(received)} of {expected} events")
+        await loop.run_in_executor(None, barrier.wait)
+        # Disconnect the clients first, so that the hub doesn't cancel their connections
+        if not bus.is_hub:
+            bus_task.cancel()
+        await loop.run_in_executor(None, barrier.wait)
+        await wait_for(lambda: len(bus._clients) == 0)
+    finally:
+        results.put((index, bus.is_hub, len(received), latencies, failures))
+        bus_task.cancel()
+        await Tortoise.close_connections()
+
+
+def worker(*args):
+    asyncio.run(worker_main(*args))
+
+
+async def populate(directory: str):
+    await Tortoise.init(db_url=db_url(directory), modules={"models": ["compolvo.models"]})
+    await Tortoise.generate_schemas()
+    await License.create(name="MIT")
+    await Tortoise.close_connections()
+
+
+def main():
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    with tempfile.TemporaryDirectory() as directory:
+        asyncio.run(populate(directory))
+        context = multiprocessing.get_context("spawn")
+        barrier = context.Barrier(workers)
+        written_at = context.Value("d", 0.0)
+        results = context.Queue()
+        processes = [context.Process(target=worker, args=(
+            i, workers, directory, barrier, written_at, results)) for i in range(workers)]
+        for process in processes:
+            process.start()
+        reports = sorted(results.get(timeout=TIMEOUT * (workers + 2)) for _ in processes)
+        for process in processes:
+            process.join()
+    failed = False
+    latencies = []
+    for index, is_hub, received, worker_latencies, failures in reports:
+        latencies += worker_latencies
+        role = f"hub, received {received} events" if is_hub else "client"
+        print(f"worker {index}: {role}" + "".join(f"\n  FAILED: {failure}" for failure in failures))
+        failed = failed or len(failures) > 0
+    if len(latencies) > 0:
+        latencies.sort()
+        print(f"catalog invalidation across workers: median {latencies[len(latencies) // 2] * 1000:.1f}"
+              f" ms, max {latencies[-1] * 1000:.1f} ms")
+    if failed or not any(is_hub for _, is_hub, *_ in reports):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+import asyncio
+import fcntl
+import json
+import os
+import uuid
+from collections import deque
+from typing import Callable, Coroutine, List, Deque, TextIO, Set, Dict
+
+from compolvo import notify
+from compolvo.notify import EventBus, Event, Recipient
+from sanic.log import logger
+
+RECONNECT_DELAY = 1
+PENDING_SIZE = 10000
+REQUEST_TIMEOUT = 5
+
+_local_bus = notify.InProcessBus()
+
+
+def _event_to_dict(event: Event) -> dict:
+    return {
+        **event.to_dict(),
+        "software_id": event.software_id,
+        "durable": event.durable
+    }
+
+
+def _event_from_dict(data: dict) -> Event:
+    event = Event.from_dict(data)
+    event.software_id = data.get("software_id")
+    event.durable = data.get("durable", False)
+    return event
+
+
+class UnixSocketBus(EventBus):
+    """Event bus for several processes on the same host, e.g. multiple Sanic workers. The process
+    holding the lock file next to the socket becomes the hub and accepts events from all other
+    processes over the Unix socket. If the hub dies, another process takes over. Cache
+    invalidations are forwarded by the hub to all other processes, and the delivery latency is
+    requested from it.
+
+    Pass `hub=True` for a process that has to become the hub (e.g. the standalone gateway) and
+    `hub=False` for processes that never should."""
+    path: str
+    hub: bool | None
+    is_hub: bool
+    _lock_file: TextIO | None
+    _writer: asyncio.StreamWriter | None
+    _pending: Deque[bytes]
+    _clients: Set[asyncio.StreamWriter]
+    _requests: Dict[str, asyncio.Future]
+
+    def __init__(self, path: str, hub: bool | None = None):
+        self.path = path
+        self.hub = hub
+        self.is_hub = False
+        self._lock_file = None
+        self._writer = None
+        self._pending = deque(maxlen=PENDING_SIZE)
+        self._clients = set()
+        self._requests = {}
+
+    def publish(self, events: List[Event]):
+        if self.is_hub:
+            _local_bus.publish(events)
+        else:
+            self._send({"op": "publish", "events": [_event_to_dict(event) for event in events]})
+
+    def cancel(self, recipient: Recipient, software_id: str):
+        if self.is_hub:
+            _local_bus.cancel(recipient, software_id)
+        else:
+            self._send({"op": "cancel", "recipient": recipient.to_dict(),
+                        "software_id": str(software_id)})
+
+    def invalidate_cache(self, name: str):
+        message = {"op": "invalidate", "name": name}
+        if self.is_hub:
+            self._broadcast(message)
+        else:
+            self._send(message)
+
+    async def get_delivery_latency(self) -> dict:
+        if self.is_hub:
+            return notify.delivery_latency.to_dict()
+        request = uuid.uuid4().hex
+        self._requests[request] = asyncio.get_running_loop().create_future()
+        self._send({"op": "latency", "request": request})
+        try:
+            return await asyncio.wait_for(self._requests[request], REQUEST_TIMEOUT)
+        finally:
+            del self._requests[request]
+
+    def _broadcast(self, message: dict, origin: asyncio.StreamWriter | None = None):
+        data = json.dumps(message).encode("utf-8") + b"\n"
+        for writer in self._clients:
+            if writer is not origin and not writer.is_closing():
+                writer.write(data)
+
+    def _send(self, message: dict):
+        data = json.dumps(message).encode("utf-8") + b"\n"
+        if self._writer is None or self._writer.is_closing():
+            # Sent once connected to the hub
+            self._pending.append(data)
+        else:
+            self._writer.write(data)
+
+    def _try_become_hub(self) -> bool:
+        if self.hub == False:
+            return False
+        lock_file = open(self.path + ".lock", "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file  # the lock is held as long as the file is open
+        self.is_hub = True
+        return True
+
+    async def run(self, run_hub: Callable[[], Coroutine]):
+        while not self._try_become_hub():
+            if self.hub == True:
+                logger.warning("Another process is the event bus hub, waiting for it to exit")
+                await asyncio.sleep(RECONNECT_DELAY)
+                continue
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                await asyncio.sleep(RECONNECT_DELAY)
+                continue
+            logger.info("Connected to event bus hub at %s", self.path)
+            while len(self._pending) > 0:
+                writer.write(self._pending.popleft())
+            self._writer = writer
+            # Invalidations might have been missed while not connected
+            notify.invalidate_local_caches()
+            # The hub only sends cache invalidations and replies, EOF means it's gone
+            while line := await reader.readline():
+                message = json.loads(line)
+                match message["op"]:
+                    case "invalidate":
+                        notify.invalidate_local_cache(message["name"])
+                    case "latency":
+                        future = self._requests.get(message["request"])
+                        if future is not None and not future.done():
+                            future.set_result(message["histogram"])
+            self._writer = None
+            writer.close()
+            logger.warning("Lost connection to event bus hub")
+        logger.info("Running as event bus hub at %s", self.path)
+        notify.invalidate_local_caches()
+        # Events published before this process became the hub
+        pending = [json.loads(data) for data in self._pending]
+        self._pending.clear()
+        for message in pending:
+            self._handle_message(message)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        server = await asyncio.start_unix_server(self._handle_connection, self.path)
+        async with server:
+            await run_hub()
+            await server.serve_forever()
+
+    def _handle_message(self, message: dict, origin: asyncio.StreamWriter | None = None):
+        match message["op"]:
+            case "publish":
+                self.publish([_event_from_dict(data) for data in message["events"]])
+            case "cancel":
+                rec = message["recipient"]
+                self.cancel(Recipient(rec["subscriber_type"], rec.get("id")),
+                            message["software_id"])
+            case "invalidate":
+                notify.invalidate_local_cache(message["name"])
+                self._broadcast(message, origin)
+            case "latency":
+                # Requests queued before this process became the hub have no one to reply to
+                if origin is not None and not origin.is_closing():
+                    reply = {"op": "latency", "request": message["request"],
+                             "histogram": notify.delivery_latency.to_dict()}
+                    origin.write(json.dumps(reply).encode("utf-8") + b"\n")
+
+    async def _handle_connection(self, reader: asyncio.StreamReader,
+                                 writer: asyncio.StreamWriter):
+        self._clients.add(writer)
+        try:
+            while line := await reader.readline():
+                try:
+                    self._handle_message(json.loads(line), writer)
+                except Exception as e:
+                    logger.exception(e)
+        finally:
+            self._clients.discard(writer)
+            writer.close()
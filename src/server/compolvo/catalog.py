@@ -0,0 +1,84 @@
+import asyncio
+import hashlib
+from collections import defaultdict
+from typing import Dict, List, Iterable, Tuple
+
+from compolvo.models import Service, Tag, ServiceOffering, PackageManagerAvailableVersion, \
+    Serializable
+from sanic import Request, HTTPResponse, raw
+from sanic.response.types import json_dumps
+
+
+async def build_service_catalog(services: Iterable[Service]) -> List[Dict]:
+    """Serialize services with their tags, offerings and operating systems in a fixed number of
+    queries, independent of the number of services."""
+    services = list(services)
+    ids = [service.id for service in services]
+    tags = defaultdict(list)
+    offerings = defaultdict(list)
+    operating_systems: Dict[str, Dict[str, None]] = defaultdict(dict)  # ordered set
+    if len(ids) > 0:
+        tag_rows = await Tag.filter(services__id__in=ids).values(*Tag.fields,
+                                                                  service_id="services__id")
+        for row in tag_rows:
+            tags[str(row["service_id"])].append(Tag.dict_from_values(row, Tag.fields))
+        service_offerings = await ServiceOffering.filter(service_id__in=ids).order_by(
+            "duration_days")
+        offering_dicts = await Serializable.list_dict(service_offerings, verify_foreign_keys=False)
+        for offering in offering_dicts:
+            offerings[offering["service"]].append(offering)
+        version_rows = await PackageManagerAvailableVersion.filter(service_id__in=ids).values_list(
+            "service_id", "operating_system_id")
+        for service_id, os_id in version_rows:
+            operating_systems[str(service_id)][str(os_id)] = None
+    catalog = []
+    for data in await Serializable.list_dict(services, verify_foreign_keys=False):
+        id = data["id"]
+        catalog.append({
+            **data,
+            "tags": tags[id],
+            "offerings": offerings[id],
+            "operating_systems": list(operating_systems[id]),
+        })
+    return catalog
+
+
+class CatalogCache:
+    """The serialized catalog of all services, kept until `invalidate` is called."""
+    version: int
+
+    def __init__(self):
+        self.version = 0
+        self._entry: Tuple[bytes, str] | None = None
+        self._lock = asyncio.Lock()
+
+    def invalidate(self):
+        self.version += 1
+        self._entry = None
+
+    async def get(self) -> Tuple[bytes, str]:
+        """Returns the JSON body and its ETag."""
+        async with self._lock:
+            entry = self._entry
+            if entry is None:
+                version = self.version
+                body = json_dumps(await build_service_catalog(await Service.all())).encode("utf-8")
+                entry = body, '"' + hashlib.sha1(body).hexdigest() + '"'
+                # Don't keep a catalog that was invalidated while it was being built
+                if version == self.version:
+                    self._entry = entry
+            return entry
+
+
+catalog_cache = CatalogCache()
+
+
+async def cached_catalog_response(request: Request) -> HTTPResponse:
+    body, etag = await catalog_cache.get()
+    headers = {"ETag": etag}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        if etag in tags or "*" in tags:
+            return HTTPResponse(status=304, headers=headers)
+    return raw(body, content_type="application/json", headers=headers)
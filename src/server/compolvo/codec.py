@@ -0,0 +1,120 @@
+import json
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Dict, List
+
+try:
+    import msgpack
+except ImportError:  # optional, connections fall back to JSON
+    msgpack = None
+
+# Short codes for the field names of the notify protocol, used by the compact encoding. Must be
+# kept in sync with the agent.
+FIELD_CODES = {
+    "event": "e",
+    "type": "t",
+    "recipient": "r",
+    "message": "m",
+    "ephemeral": "x",
+    "subscriber_type": "st",
+    "subscriber": "sr",
+    "subscription": "sn",
+    "event_type": "et",
+    "id": "i",
+    "sub_id": "si",
+    "intent": "in",
+    "success": "s",
+    "error": "er",
+    "agent_id": "a",
+    "service": "sv",
+    "software": "sw",
+    "software_id": "sid",
+    "version": "v",
+    "status": "ss",
+    "installed_version": "iv",
+    "corrupt": "c",
+    "installing": "ig",
+    "uninstalling": "ug",
+    "sha256": "h",
+    "command": "cm",
+}
+FIELD_NAMES = {code: name for name, code in FIELD_CODES.items()}
+# Prepended to keys of the payload that look like a code, so that decoding doesn't rename them
+ESCAPE = "~"
+
+
+def _encode_key(key: Any) -> Any:
+    if key in FIELD_CODES:
+        return FIELD_CODES[key]
+    if isinstance(key, str) and (key in FIELD_NAMES or key.startswith(ESCAPE)):
+        return ESCAPE + key
+    return key
+
+
+def _decode_key(key: Any) -> Any:
+    if isinstance(key, str) and key.startswith(ESCAPE):
+        return key[len(ESCAPE):]
+    return FIELD_NAMES.get(key, key)
+
+
+def _rename(obj: Any, rename_key: Callable[[Any], Any]) -> Any:
+    if isinstance(obj, dict):
+        return {rename_key(key): _rename(value, rename_key) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [_rename(value, rename_key) for value in obj]
+    return obj
+
+
+class Codec(ABC):
+    name: str
+
+    @abstractmethod
+    def encode(self, data: Dict) -> str | bytes:
+        pass
+
+    @abstractmethod
+    def decode(self, data: str | bytes) -> Dict:
+        pass
+
+
+class JSONCodec(Codec):
+    name = "json"
+
+    def encode(self, data: Dict) -> str:
+        return json.dumps(data)
+
+    def decode(self, data: str | bytes) -> Dict:
+        return json.loads(data)
+
+
+class MsgpackCodec(Codec):
+    """msgpack in binary frames with field names replaced by `FIELD_CODES`. Other keys that are a
+    code or start with `ESCAPE` are escaped, so that any payload is decoded as it was encoded."""
+    name = "msgpack-v1"
+
+    def encode(self, data: Dict) -> bytes:
+        return msgpack.packb(_rename(data, _encode_key))
+
+    def decode(self, data: str | bytes) -> Dict:
+        return _rename(msgpack.unpackb(data), _decode_key)
+
+
+json_codec = JSONCodec()
+CODECS: Dict[str, Codec] = {codec.name: codec for codec in
+                            [MsgpackCodec() if msgpack is not None else None, json_codec] if
+                            codec is not None}
+
+
+def negotiate_codec(offered: List[str] | None) -> Codec:
+    """The first encoding offered by the client that is supported here, JSON otherwise."""
+    for name in offered or []:
+        codec = CODECS.get(name)
+        if codec is not None:
+            return codec
+    return json_codec
+
+
+def decode_frame(frame: str | bytes, codec: Codec) -> Dict:
+    # Text frames are always JSON, e.g. the login before an encoding has been negotiated
+    if isinstance(frame, str):
+        return json_codec.decode(frame)
+    return codec.decode(frame)
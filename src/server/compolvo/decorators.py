@@ -1,12 +1,16 @@
+from base64 import urlsafe_b64encode, urlsafe_b64decode
 from functools import wraps
-from typing import Type, Set
+from typing import Type, Set, List, Dict, Any, Tuple, Callable, Awaitable, Iterable
 
 import stripe as stripe_module
 from compolvo.models import Serializable, UserRole, User
 from compolvo.utils import check_token_for_request, Unauthorized
 from compolvo.utils import user_has_roles
-from sanic import HTTPResponse, text
+from sanic import HTTPResponse, text, Request, json
 from sanic.exceptions import BadRequest, NotFound
+from sanic.response.types import json_dumps
+from tortoise.fields import BooleanField
+from tortoise.queryset import QuerySet
 
 
 def patch_endpoint(cls: Type[Serializable]):
@@ -51,7 +55,137 @@ def delete_endpoint(cls: Type[Serializable]):
     return decorator
 
 
-def get_endpoint(cls: Type[Serializable], listing_requires: Set[UserRole.Role] = None):
+STREAM_CHUNK_SIZE = 500
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+LISTING_PARAMETERS = {"id", "limit", "cursor", "fields"}
+
+
+def encode_cursor(pk) -> str:
+    return urlsafe_b64encode(str(pk).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> str:
+    try:
+        pk = urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+    except (ValueError, UnicodeError):
+        pk = ""
+    if pk == "":
+        raise BadRequest("Invalid cursor.")
+    return pk
+
+
+class ListingQuery:
+    """The `limit`, `cursor`, `fields` and equality filter query parameters of a listing."""
+    limit: int | None
+    after: str | None
+    fields: List[str] | None
+    filters: Dict[str, Any]
+
+    def __init__(self, cls: Type[Serializable], request: Request):
+        args = request.args
+        self.limit = None
+        if "limit" in args:
+            try:
+                self.limit = int(args.get("limit"))
+            except ValueError:
+                raise BadRequest("Parameter limit must be an integer.")
+            if self.limit < 1:
+                raise BadRequest("Parameter limit must be positive.")
+            self.limit = min(self.limit, MAX_PAGE_SIZE)
+        cursor = args.get("cursor")
+        self.after = decode_cursor(cursor) if cursor is not None else None
+        if self.after is not None and self.limit is None:
+            self.limit = DEFAULT_PAGE_SIZE
+        self.fields = None
+        if "fields" in args:
+            self.fields = args.get("fields").split(",")
+            unknown = set(self.fields) - set(cls.fields)
+            if len(unknown) > 0:
+                raise BadRequest(f"Unknown field(s) on {cls.__name__}: {', '.join(sorted(unknown))}")
+        self.filters = {}
+        filter_fields = getattr(cls, "filter_fields", [])
+        for key in set(args.keys()) - LISTING_PARAMETERS:
+            if key not in filter_fields:
+                if key in cls.fields:
+                    raise BadRequest(f"Filtering {cls.__name__} by '{key}' is not supported.")
+                continue
+            value = args.get(key)
+            field = cls._meta.fields_map[key]
+            if key in cls._meta.fk_fields:
+                key = field.source_field
+            elif isinstance(field, BooleanField):
+                value = value.lower() in ("true", "1")
+            self.filters[key] = value
+
+    @property
+    def paginated(self) -> bool:
+        return self.limit is not None
+
+    def project(self, data: List[Dict]) -> List[Dict]:
+        if self.fields is None:
+            return data
+        return [{field: row[field] for field in self.fields} for row in data]
+
+    def page_json(self, data: List[Dict], last_pk) -> HTTPResponse:
+        next_cursor = encode_cursor(last_pk) if len(data) == self.limit else None
+        return json({"items": data, "next_cursor": next_cursor})
+
+
+def keyset_page(queryset: QuerySet, after, limit: int) -> QuerySet:
+    """Rows of `queryset` after the primary key `after`, so each page is a bounded, indexed
+    query no matter how deep it is."""
+    pk = queryset.model._meta.pk_attr
+    if after is not None:
+        queryset = queryset.filter(**{f"{pk}__gt": after})
+    return queryset.order_by(pk).limit(limit)
+
+
+async def serialize_page(queryset: QuerySet, listing: ListingQuery, after, limit: int) -> \
+        Tuple[List[Dict], Any]:
+    return await serialize_rows(keyset_page(queryset, after, limit), listing)
+
+
+async def serialize_rows(queryset: QuerySet, listing: ListingQuery) -> Tuple[List[Dict], Any]:
+    """Serializes the rows of `queryset`, only loading the requested `fields`. Returns them with
+    the primary key of the last row."""
+    model = queryset.model
+    if listing.fields is None:
+        objects = await queryset
+        data = await Serializable.list_dict(objects, verify_foreign_keys=False)
+        return data, objects[-1].pk if len(objects) > 0 else None
+    pk = model._meta.pk_attr
+    columns = dict.fromkeys([pk, *model.value_attributes(listing.fields)])
+    rows = await queryset.values(*columns)
+    data = [model.dict_from_values(row, listing.fields) for row in rows]
+    return data, rows[-1][pk] if len(rows) > 0 else None
+
+
+async def stream_json_list(request: Request, queryset: QuerySet, listing: ListingQuery):
+    response = await request.respond(content_type="application/json")
+    await response.send("[")
+    separator = ""
+    last_pk = None
+    while True:
+        data, last_pk = await serialize_page(queryset, listing, last_pk, STREAM_CHUNK_SIZE)
+        if len(data) > 0:
+            await response.send(separator + ",".join(map(json_dumps, data)))
+            separator = ","
+        if len(data) < STREAM_CHUNK_SIZE:
+            break
+    await response.send("]")
+    await response.eof()
+
+
+Serializer = Callable[[Iterable[Serializable]], Awaitable[List[Dict]]]
+
+
+def get_endpoint(cls: Type[Serializable], listing_requires: Set[UserRole.Role] = None,
+                 stream: bool = False, serialize: Serializer | None = None):
+    """Listings accept `limit`/`cursor` (answered as `{"items": ..., "next_cursor": ...}`), `fields`
+    and equality filters on the model's `filter_fields`. The handler gets the unevaluated queryset
+    of a listing. With `stream`, the listing is written out in chunks. `serialize` replaces the
+    default serialization of the instances, `fields` are then picked from its output."""
     def decorator(func):
         @wraps(func)
         async def wrapper(request, *args, **kwargs):
@@ -64,18 +198,33 @@ def get_endpoint(cls: Type[Serializable], listing_requires: Set[UserRole.Role] =
                 if listing_requires is not None and not await user_has_roles(user,
                                                                              listing_requires):
                     raise Unauthorized()
-                instances = await cls.all()
-                return_value = await func(request, instances, *args, **kwargs)
+                listing = ListingQuery(cls, request)
+                queryset = cls.filter(**listing.filters)
+                return_value = await func(request, queryset, *args, **kwargs)
                 if return_value is not None:
                     return return_value
-                return await Serializable.list_json(instances)
+                if listing.paginated:
+                    queryset = keyset_page(queryset, listing.after, listing.limit)
+                elif stream and serialize is None:
+                    return await stream_json_list(request, queryset, listing)
+                if serialize is not None:
+                    instances = await queryset
+                    data = listing.project(await serialize(instances))
+                    last_pk = instances[-1].pk if len(instances) > 0 else None
+                else:
+                    data, last_pk = await serialize_rows(queryset, listing)
+                if listing.paginated:
+                    return listing.page_json(data, last_pk)
+                return json(data)
             instance = await cls.get_or_none(id=instance_id)
             if instance is None:
                 raise NotFound(f"Specified {cls.__name__} not found.")
             return_value = await func(request, instance, *args, **kwargs)
             if return_value is not None:
                 return return_value
-            return await instance.json()
+            if serialize is not None:
+                return json((await serialize([instance]))[0])
+            return await instance.json(verify_foreign_keys=False)
 
         return wrapper
 
@@ -1,53 +1,154 @@
 import datetime
 import enum
+from collections import defaultdict
 from enum import IntEnum
-from typing import List, Type, Iterable
+from typing import List, Type, Iterable, Dict, Set, Iterator, Callable, Any, Tuple, NamedTuple
 from uuid import UUID
 
-import tortoise.queryset
 from sanic import json
 from tortoise.fields import UUIDField, TextField, CharField, IntEnumField, FloatField, IntField, \
-    DatetimeField, BooleanField, ForeignKeyField, ManyToManyField
-from tortoise.fields.relational import _NoneAwaitable
+    DatetimeField, BooleanField, ForeignKeyField, ManyToManyField, Field, BigIntField, JSONField
+from tortoise.fields.data import IntEnumFieldInstance
 from tortoise.models import Model
 
 
+Encoder = Callable[[Any], Any]
+
+
+def _encode_str(value) -> str | None:
+    return str(value) if value is not None else None
+
+
+def _encode_datetime(value: datetime.datetime | None) -> str | None:
+    return value.isoformat() if value is not None else None
+
+
+def _encode_int(value) -> int | None:
+    return int(value) if value is not None else None
+
+
+def _encode_any(value):
+    if isinstance(value, UUID):
+        return str(value)
+    elif isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+_ENCODERS: List[Tuple[Type[Field], Encoder | None]] = [
+    (UUIDField, _encode_str),
+    (DatetimeField, _encode_datetime),
+    (IntEnumFieldInstance, _encode_int),
+    (Field, None),
+]
+
+
+class SerializerStep(NamedTuple):
+    field: str
+    attribute: str
+    encoder: Encoder | None
+    related_model: Type[Model] | None
+
+
 class Serializable:
     fields: List[str]
 
-    async def to_dict(self):
+    @classmethod
+    def serializer_plan(cls) -> List[SerializerStep]:
+        """The steps for serializing `fields`, compiled once per class after Tortoise is initialized."""
+        plan = cls.__dict__.get("_serializer_plan")
+        if plan is None:
+            plan = [cls._compile_serializer_step(field) for field in cls.fields]
+            cls._serializer_plan = plan
+        return plan
+
+    @classmethod
+    def _compile_serializer_step(cls, field: str) -> SerializerStep:
+        field_object = cls._meta.fields_map.get(field)
+        if field in cls._meta.fk_fields:
+            return SerializerStep(field, field_object.source_field, None,
+                                  field_object.related_model)
+        if field_object is None:
+            return SerializerStep(field, field, _encode_any, None)
+        encoder = next(encoder for field_type, encoder in _ENCODERS
+                       if isinstance(field_object, field_type))
+        return SerializerStep(field, field, encoder, None)
+
+    async def to_dict(self, related_ids: Dict[Type[Model], Set[str]] | None = None,
+                      verify_foreign_keys: bool = True):
+        """Without `verify_foreign_keys`, the stored `<field>_id`s are emitted without a query, even
+        for related objects that are already fetched."""
+        if related_ids is None and verify_foreign_keys:
+            related_ids = await Serializable._fetch_related_ids([self])
+        data = {}
+        for field, attribute, encoder, related_model in self.serializer_plan():
+            if related_model is None:
+                value = getattr(self, attribute)
+                data[field] = value if encoder is None else encoder(value)
+                continue
+            # Tortoise caches fetched related objects as `_<field>` on the instance
+            related = self.__dict__.get(f"_{field}") if verify_foreign_keys else None
+            if related is not None:
+                data[field] = await related.to_dict()
+                continue
+            related_id = getattr(self, attribute)
+            if related_id is not None:
+                related_id = str(related_id)
+                if verify_foreign_keys and related_id not in related_ids.get(related_model, ()):
+                    related_id = None
+            data[field] = related_id
+        return data
+
+    @classmethod
+    def value_attributes(cls, fields: Iterable[str]) -> List[str]:
+        """The columns to pass to `.values()` for serializing `fields` with `dict_from_values`."""
+        return [step.attribute for step in cls.serializer_plan() if step.field in fields]
+
+    @classmethod
+    def dict_from_values(cls, row: Dict[str, Any], fields: Iterable[str]) -> Dict[str, Any]:
         data = {}
-        for field in self.fields:
-            value = getattr(self, field)
-            if isinstance(value, UUID):
-                value = str(value)
-            elif isinstance(value, datetime.datetime):
-                value = value.isoformat()
-            elif isinstance(value, tortoise.queryset.QuerySet):
-                value = await value.get_or_none()
-                try:
-                    value = await value.to_dict()
-                    if "id" in value.keys():
-                        value = value["id"]
-                except AttributeError:
-                    value = str(value)
-            elif isinstance(value, Serializable):
-                value = await value.to_dict()
-            elif isinstance(value, _NoneAwaitable):
-                value = None
-            data[field] = value
+        for field, attribute, encoder, related_model in cls.serializer_plan():
+            if field not in fields:
+                continue
+            value = row[attribute]
+            if related_model is not None:
+                encoder = _encode_str
+            data[field] = value if encoder is None else encoder(value)
         return data
 
-    async def json(self):
-        return json(await self.to_dict())
+    def _unfetched_foreign_keys(self) -> Iterator[SerializerStep]:
+        for step in self.serializer_plan():
+            if step.related_model is not None and f"_{step.field}" not in self.__dict__:
+                yield step
 
     @staticmethod
-    async def list_json(objects: Iterable["Serializable"]):
-        return json(await Serializable.list_dict(objects))
+    async def _fetch_related_ids(objects: Iterable["Serializable"]) -> Dict[Type[Model], Set[str]]:
+        """Look up which referenced rows exist, using one query per related model."""
+        requested: Dict[Type[Model], Set[str]] = defaultdict(set)
+        for obj in objects:
+            for step in obj._unfetched_foreign_keys():
+                related_id = getattr(obj, step.attribute)
+                if related_id is not None:
+                    requested[step.related_model].add(str(related_id))
+        existing = {}
+        for model, ids in requested.items():
+            pks = await model.filter(pk__in=ids).values_list(model._meta.pk_attr, flat=True)
+            existing[model] = set(map(str, pks))
+        return existing
+
+    async def json(self, verify_foreign_keys: bool = True):
+        return json(await self.to_dict(verify_foreign_keys=verify_foreign_keys))
 
     @staticmethod
-    async def list_dict(objects: Iterable["Serializable"]):
-        return [await object.to_dict() for object in objects]
+    async def list_json(objects: Iterable["Serializable"], verify_foreign_keys: bool = True):
+        return json(await Serializable.list_dict(objects, verify_foreign_keys))
+
+    @staticmethod
+    async def list_dict(objects: Iterable["Serializable"], verify_foreign_keys: bool = True):
+        objects = list(objects)
+        related_ids = await Serializable._fetch_related_ids(
+            objects) if verify_foreign_keys else None
+        return [await object.to_dict(related_ids, verify_foreign_keys) for object in objects]
 
     @staticmethod
     async def all_json(cls: Type[Model]):
@@ -80,6 +181,7 @@ class User(Model, Serializable):
     billing_cycle = ForeignKeyField("models.BillingCycle", "users")
 
     fields = ["id", "first_name", "last_name", "email", "billing_cycle"]
+    filter_fields = ["email", "billing_cycle"]
 
 
 class UserRole(Model, Serializable):
@@ -112,6 +214,7 @@ class Service(Model, Serializable):
 
     fields = ["id", "system_name", "name", "short_description", "description", "license",
               "download_count"]
+    filter_fields = ["system_name", "license"]
 
 
 class OperatingSystem(Model, Serializable):
@@ -120,6 +223,7 @@ class OperatingSystem(Model, Serializable):
     system_name = CharField(255, unique=True)
 
     fields = ["id", "name", "system_name"]
+    filter_fields = ["system_name"]
 
 
 class PackageManager(Model, Serializable):
@@ -145,6 +249,7 @@ class License(Model, Serializable):
     name = TextField()
 
     fields = ["id", "name"]
+    filter_fields = ["name"]
 
 
 class Tag(Model, Serializable):
@@ -152,6 +257,7 @@ class Tag(Model, Serializable):
     label = TextField()
 
     fields = ["id", "label"]
+    filter_fields = ["label"]
 
 
 class ServiceOffering(Model, Serializable):
@@ -164,6 +270,7 @@ class ServiceOffering(Model, Serializable):
     stripe_price_id = TextField(null=True)
 
     fields = ["id", "name", "service", "description", "price", "duration_days"]
+    filter_fields = ["name", "service"]
 
 
 class ServicePlan(Model, Serializable):
@@ -178,6 +285,7 @@ class ServicePlan(Model, Serializable):
 
     fields = ["id", "service_offering", "user", "start_date", "end_date", "canceled_by_user",
               "canceled_at"]
+    filter_fields = ["service_offering", "user", "canceled_by_user"]
 
 
 class Agent(Model, Serializable):
@@ -195,6 +303,8 @@ class Agent(Model, Serializable):
     fields = ["id", "name", "user", "connection_from_ip_address", "last_connection_start",
               "last_connection_end", "connected",
               "connection_interrupted", "initialized", "operating_system"]
+    filter_fields = ["user", "connected", "connection_interrupted", "initialized",
+                     "operating_system"]
 
 
 class AgentSoftware(Model, Serializable):
@@ -209,11 +319,26 @@ class AgentSoftware(Model, Serializable):
 
     fields = ["id", "agent", "service_plan", "installed_version", "corrupt", "installing",
               "uninstalling", "last_updated"]
+    filter_fields = ["agent", "service_plan", "corrupt", "installing", "uninstalling"]
 
     class Meta:
         unique_together = (("agent", "service_plan"),)
 
 
+class PendingAgentCommand(Model, Serializable):
+    """Install/uninstall command that hasn't been acknowledged by the agent yet."""
+    id = BigIntField(pk=True)  # auto increment, gives the order the commands were issued in
+    # Sent along with the command and echoed back in the agent's status update
+    command_id = UUIDField(unique=True)
+    agent = ForeignKeyField("models.Agent", "pending_commands")
+    software = ForeignKeyField("models.AgentSoftware", "pending_commands")
+    type = CharField(32)
+    message = JSONField()
+    created_at = DatetimeField(auto_now_add=True)
+
+    fields = ["id", "command_id", "agent", "software", "type", "message", "created_at"]
+
+
 class ServerStatus(Model, Serializable):
     id = UUIDField(pk=True)
     server_id = CharField(255, unique=True)
@@ -221,3 +346,4 @@ class ServerStatus(Model, Serializable):
     performing_billing_maintenance = BooleanField(default=False)
 
     fields = ["id", "server_id", "server_running", "performing_billing_maintenance"]
+    filter_fields = ["server_id", "server_running", "performing_billing_maintenance"]
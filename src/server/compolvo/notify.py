@@ -1,14 +1,19 @@
 import asyncio
+import bisect
 import datetime
 import enum
 import json
+import random
+import time
 import uuid
-from queue import Queue
-from typing import Callable, Dict, List, Coroutine, Set
+from abc import ABC, abstractmethod
+from collections import deque, defaultdict
+from typing import Callable, Dict, List, Coroutine, Set, Iterable, Tuple, Deque
 from uuid import UUID
 
 import websockets
-from compolvo.models import Agent, AgentSoftware
+from compolvo.codec import Codec, json_codec, negotiate_codec, decode_frame
+from compolvo.models import Agent, AgentSoftware, PendingAgentCommand
 from sanic.log import logger
 from websockets import ConnectionClosed, ConnectionClosedOK, ConnectionClosedError
 
@@ -83,13 +88,23 @@ class Event:
     recipient: Recipient | None
     message: Dict
     ephemeral: bool
+    software_id: str | None
+    sequence: int | None
+    queued_at: float | None
+    attempts: int
+    durable: bool
 
     def __init__(self, type: EventType, recipient: Recipient | None, message: Dict,
-                 ephemeral: bool = True):
+                 ephemeral: bool = True, software_id: str | None = None):
         self.type = type
         self.recipient = recipient
         self.message = message
         self.ephemeral = ephemeral
+        self.software_id = software_id
+        self.sequence = None
+        self.queued_at = None
+        self.attempts = 0
+        self.durable = False
 
     def __repr__(self):
         return str(self.to_dict())
@@ -105,6 +120,13 @@ class Event:
             "ephemeral": self.ephemeral
         }
 
+    @classmethod
+    def from_dict(cls, data: dict) -> "Event":
+        rec = data.get("recipient")
+        if rec is not None:
+            rec = Recipient(rec["subscriber_type"], rec.get("id"))
+        return cls(EventType(data["type"]), rec, data["message"], data.get("ephemeral", True))
+
 
 class Subscription:
     subscriber: Subscriber
@@ -130,66 +152,374 @@ class Subscription:
         }
 
 
-class Cancellation:
-    type: EventType
-    recipient: Recipient
+class LatencyHistogram:
+    """Cumulative histogram of latencies in seconds with fixed bucket bounds."""
+    bounds: Tuple[float, ...]
+    counts: List[int]
+    total: float
 
-    def __init__(self, type: EventType, recipient: Recipient):
-        self.type = type
-        self.recipient = recipient
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
 
     def to_dict(self):
+        buckets = {str(bound): count for bound, count in zip(self.bounds, self.counts)}
+        buckets["inf"] = self.counts[-1]
         return {
-            "type": self.type.value,
-            "recipient": self.recipient.to_dict()
+            "buckets": buckets,
+            "count": sum(self.counts),
+            "sum": self.total
         }
 
-    def __hash__(self):
-        return hash((self.type, self.recipient))
-
-    def __eq__(self, other):
-        return hash(self) == hash(other)
-
 
 EventHandler = Callable[[Event], Coroutine[None, None, bool | None]]
 SubscriptionCallback = Callable[[Subscription], Coroutine[None, None, None]]
 
-_connection_handlers: Dict[Subscription, EventHandler] = {}
-_event_queue: Queue[Event] = Queue()
-_cancellations: Set[Cancellation] = set()
+
+class SubscriptionRegistry:
+    """Subscriptions indexed by event type, subscriber type and subscriber id, so that finding the
+    handlers for an event only visits matching subscriptions. Subscriptions without an id are
+    kept in the `None` bucket and match every recipient id."""
+    _by_id: Dict[UUID, Subscription]
+    _index: Dict[EventType, Dict[SubscriberType, Dict[str | None, Dict[Subscription, EventHandler]]]]
+
+    def __init__(self):
+        self._by_id = {}
+        self._index = {}
+
+    def add(self, subscription: Subscription, handler: EventHandler):
+        subscriber = subscription.subscriber
+        bucket = self._index.setdefault(subscriber.event_type, {}).setdefault(
+            subscriber.type, {}).setdefault(subscriber.id, {})
+        bucket[subscription] = handler
+        self._by_id[subscription.id] = subscription
+
+    def remove(self, subscription_id: UUID):
+        subscription = self._by_id.pop(subscription_id, None)
+        if subscription is None:
+            return
+        subscriber = subscription.subscriber
+        by_subscriber_type = self._index[subscriber.event_type]
+        by_id = by_subscriber_type[subscriber.type]
+        bucket = by_id[subscriber.id]
+        bucket.pop(subscription, None)
+        # Drop empty buckets so that short-lived connections don't leave keys behind
+        if len(bucket) == 0:
+            del by_id[subscriber.id]
+            if len(by_id) == 0:
+                del by_subscriber_type[subscriber.type]
+                if len(by_subscriber_type) == 0:
+                    del self._index[subscriber.event_type]
+
+    def handlers_for(self, event: Event) -> List[Tuple[Subscription, EventHandler]]:
+        by_subscriber_type = self._index.get(event.type, {})
+        recipient = event.recipient
+        if recipient is None:
+            buckets = [bucket for by_id in by_subscriber_type.values() for bucket in
+                       by_id.values()]
+        else:
+            by_id = by_subscriber_type.get(recipient.subscriber_type, {})
+            if recipient.id is None:
+                buckets = list(by_id.values())
+            else:
+                buckets = [by_id[id] for id in (recipient.id, None) if id in by_id]
+        return [item for bucket in buckets for item in bucket.items()]
+
+
+DEFAULT_DISPATCH_TASKS = 4
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 30
+HANDLER_TIMEOUT = 10
+SEND_TIMEOUT = 10
+OUTBOX_SIZE = 256
+MAILBOX_SIZE = 1000
+LOGIN_RATE = 200  # logins per second
+LOGIN_BURST = 500
+LOGIN_BATCH_DELAY = 0.05
+LOGIN_BATCH_SIZE = 500
+RELOAD_COALESCE_DELAY = 0.5
+
+RecipientKey = Tuple[str | None, str | None]
+CancellationKey = Tuple[RecipientKey, str]
+
+_subscriptions = SubscriptionRegistry()
+# One queue per dispatch task, events for the same recipient always end up in the same queue so
+# that they are delivered in order
+_event_queues: List[asyncio.Queue[Event]] = [asyncio.Queue()]
+_last_sequence = 0
+# Events with a sequence number up to the watermark are cancelled. A watermark is evicted once
+# none of the events it applies to are left.
+_cancellations: Dict[CancellationKey, int] = {}
+_live_commands: Dict[CancellationKey, int] = {}
+_logged_in_agents: Set[str] = set()
+# Events nobody is subscribed to yet, kept until their recipient subscribes
+_mailboxes: Dict[RecipientKey, Dict[EventType, Deque[Event]]] = {}
+delivery_latency = LatencyHistogram((0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30, 300))
+
+
+def _recipient_key(recipient: Recipient | None) -> RecipientKey:
+    if recipient is None:
+        return None, None
+    return str(recipient.subscriber_type), recipient.id
+
+
+def _cancellation_key(event: Event) -> CancellationKey | None:
+    if event.software_id is None:
+        return None
+    return _recipient_key(event.recipient), event.software_id
+
+
+def _is_cancelled(event: Event) -> bool:
+    key = _cancellation_key(event)
+    return key is not None and event.sequence <= _cancellations.get(key, 0)
+
+
+def _finish(event: Event):
+    """Called once an event has left the system for good, i.e. it won't be dispatched again."""
+    key = _cancellation_key(event)
+    if key is None:
+        return
+    remaining = _live_commands.get(key, 0) - 1
+    if remaining > 0:
+        _live_commands[key] = remaining
+    else:
+        _live_commands.pop(key, None)
+        _cancellations.pop(key, None)
 
 
-def get_subscribers_for_event(event: Event) -> List[Subscriber]:
-    subscribers = set(map(lambda sub: sub.subscriber, _connection_handlers.keys()))
+def _put(event: Event):
+    key = _recipient_key(event.recipient)
+    _event_queues[hash(key) % len(_event_queues)].put_nowait(event)
 
-    def subscriber_is_included(subscriber: Subscriber) -> bool:
-        if subscriber.event_type != event.type or (
-                event.recipient is not None and subscriber.type != event.recipient.subscriber_type):
-            return False
-        return event.recipient is None or subscriber.id == event.recipient.id or event.recipient.id is None or subscriber.id is None
 
-    return list(filter(subscriber_is_included, subscribers))
+def _park(event: Event):
+    mailbox = _mailboxes.setdefault(_recipient_key(event.recipient), {}).setdefault(
+        event.type, deque(maxlen=MAILBOX_SIZE))
+    if len(mailbox) == mailbox.maxlen:
+        logger.warning("Mailbox of %s is full, dropping oldest event", event.recipient)
+        _finish(mailbox[0])
+    mailbox.append(event)
+
+
+def _take_mail(key: RecipientKey, event_type: EventType) -> List[Event]:
+    mailbox = _mailboxes.get(key)
+    if mailbox is None:
+        return []
+    events = mailbox.pop(event_type, [])
+    if len(mailbox) == 0:
+        del _mailboxes[key]
+    return list(events)
+
+
+def flush_mailbox(subscriber: Subscriber):
+    """Queue the parked events the subscriber is now able to receive."""
+    type = str(subscriber.type)
+    if subscriber.id is None:
+        keys = [key for key in _mailboxes if key[0] == type]
+    else:
+        keys = [(type, subscriber.id), (type, None)]
+    keys.append((None, None))
+    events = [event for key in keys for event in _take_mail(key, subscriber.event_type)]
+    for event in sorted(events, key=lambda event: event.queued_at or 0):
+        _put(event)
+
+
+def _discard_durable_mail(recipient: Recipient):
+    """Durable events are replayed from the database on the next login anyway."""
+    mailbox = _mailboxes.get(_recipient_key(recipient), {})
+    for event_type, events in list(mailbox.items()):
+        for event in events:
+            if event.durable:
+                _finish(event)
+        mailbox[event_type] = deque((event for event in events if not event.durable),
+                                    maxlen=MAILBOX_SIZE)
+        if len(mailbox[event_type]) == 0:
+            del mailbox[event_type]
+    if len(mailbox) == 0:
+        _mailboxes.pop(_recipient_key(recipient), None)
+
+
+def _enqueue(event: Event):
+    global _last_sequence
+    _last_sequence += 1
+    event.sequence = _last_sequence
+    event.queued_at = time.monotonic()
+    key = _cancellation_key(event)
+    if key is not None:
+        _live_commands[key] = _live_commands.get(key, 0) + 1
+    _put(event)
+
+
+def _cancel(recipient: Recipient, software_id: str):
+    key = _recipient_key(recipient), str(software_id)
+    if key in _live_commands:
+        _cancellations[key] = _last_sequence
+
+
+class EventBus(ABC):
+    """Carries events and cancellations from the process they originate in to the hub, the process
+    running the dispatcher and the WebSocket server. Cache invalidations are carried to all
+    processes."""
+
+    @abstractmethod
+    def publish(self, events: List[Event]):
+        pass
+
+    @abstractmethod
+    def cancel(self, recipient: Recipient, software_id: str):
+        pass
+
+    @abstractmethod
+    def invalidate_cache(self, name: str):
+        """Invalidates the cache in all other processes."""
+
+    @abstractmethod
+    async def get_delivery_latency(self) -> dict:
+        """The delivery latency histogram of the hub, where events are dispatched."""
+
+    @abstractmethod
+    async def run(self, run_hub: Callable[[], Coroutine]):
+        """Runs the bus, calling `run_hub` if this process becomes the hub."""
+
+
+class InProcessBus(EventBus):
+    """The current process is the hub."""
+
+    def publish(self, events: List[Event]):
+        for event in events:
+            _enqueue(event)
+
+    def cancel(self, recipient: Recipient, software_id: str):
+        _cancel(recipient, software_id)
+
+    def invalidate_cache(self, name: str):
+        pass
+
+    async def get_delivery_latency(self) -> dict:
+        return delivery_latency.to_dict()
+
+    async def run(self, run_hub: Callable[[], Coroutine]):
+        await run_hub()
+
+
+_bus: EventBus = InProcessBus()
+_caches: Dict[str, Callable[[], None]] = {}
+
+
+def set_bus(bus: EventBus):
+    global _bus
+    _bus = bus
+
+
+def register_cache(name: str, invalidate: Callable[[], None]):
+    """Registers a cache of data that can be changed by any process sharing the bus."""
+    _caches[name] = invalidate
+
+
+def invalidate_cache(name: str):
+    invalidate_local_cache(name)
+    _bus.invalidate_cache(name)
+
+
+def invalidate_local_cache(name: str):
+    invalidate = _caches.get(name)
+    if invalidate is not None:
+        invalidate()
+
+
+def invalidate_local_caches():
+    for invalidate in _caches.values():
+        invalidate()
+
+
+async def get_delivery_latency() -> dict:
+    return await _bus.get_delivery_latency()
 
 
 def queue(event: Event):
-    _event_queue.put(event)
+    _bus.publish([event])
+
+
+def queue_many(events: Iterable[Event]):
+    _bus.publish(list(events))
+
+
+async def queue_durable(events: Iterable[Event]):
+    """Persist agent commands before queueing them. They are replayed whenever the agent logs in
+    until it acknowledges them by reporting the status of the software along with the command's
+    id."""
+    events = list(events)
+    commands = []
+    for event in events:
+        command_id = uuid.uuid4()
+        event.message = {**event.message, "command": str(command_id)}
+        commands.append(PendingAgentCommand(command_id=command_id, agent_id=event.recipient.id,
+                                            software_id=event.software_id, type=event.type.value,
+                                            message=event.message))
+    await PendingAgentCommand.bulk_create(commands)
+    for event in events:
+        event.durable = True
+    queue_many(events)
+
+
+async def replay_pending_commands(agent: Agent, commands: List[PendingAgentCommand] | None = None):
+    if commands is None:
+        commands = await PendingAgentCommand.filter(agent_id=agent.id).order_by("id")
+    recipient = Recipient(SubscriberType.AGENT, str(agent.id))
+    events = []
+    for command in commands:
+        event = Event(EventType(command.type), recipient, command.message, False,
+                      str(command.software_id))
+        event.durable = True
+        events.append(event)
+    if len(events) > 0:
+        logger.debug("Replaying %s pending commands for agent %s", len(events), agent.id)
+        queue_many(events)
+
+
+async def acknowledge_pending_command(software_id: str, command_id: str | None):
+    if command_id is not None:
+        # Duplicate status updates for a replayed command don't acknowledge any other command
+        await PendingAgentCommand.filter(command_id=command_id, software_id=software_id).delete()
+        return
+    # Agents that don't echo the command's id
+    command = await PendingAgentCommand.filter(software_id=software_id).order_by("id").first()
+    if command is not None:
+        await command.delete()
+
+
+def has_subscribers(event: Event) -> bool:
+    return len(_subscriptions.handlers_for(event)) > 0
+
+
+async def _deliver(subscription: Subscription, handler: EventHandler, event: Event) -> bool:
+    try:
+        result = await asyncio.wait_for(handler(event), HANDLER_TIMEOUT)
+        return result != False  # A None return value is not a failure
+    except asyncio.TimeoutError:
+        logger.warning("Delivery of %s to %s timed out", event, subscription)
+    except ConnectionClosed:
+        pass
+    except Exception as e:
+        logger.exception(e)
+    return False
 
 
 async def _notify(event: Event) -> bool:
-    subscribers = get_subscribers_for_event(event)
-    if len(subscribers) == 0:
+    # handlers_for returns a copy as the registry might change during iteration
+    # that isn't fatal however, as newly unregistered handlers need to deal with potentially being invoked after that
+    handlers = _subscriptions.handlers_for(event)
+    if len(handlers) == 0:
         logger.debug("No subscribers, unsuccessful delivery.")
         return False
-    success = True
-    # collect items first as dict might change during iteration
-    # that isn't fatal however, as newly unregistered handlers need to deal with potentially being invoked after that
-    connection_handlers = set(_connection_handlers.items())
-    for subscription, handler in connection_handlers:
-        if subscription.subscriber in subscribers:
-            result = await handler(event)
-            if result == False:  # A None return value is not a failure
-                success = False
-    return success
+    results = await asyncio.gather(
+        *(_deliver(subscription, handler, event) for subscription, handler in handlers))
+    return all(results)
 
 
 def subscribe(type: SubscriberType, event_type: EventType, handler: EventHandler,
@@ -198,98 +528,215 @@ def subscribe(type: SubscriberType, event_type: EventType, handler: EventHandler
     # (e.g. reload & login events only for users with restricted id)
     subscriber = Subscriber(type, event_type, id)
     subscription = Subscription(subscriber, uuid.uuid4())
-    _connection_handlers[subscription] = handler
+    _subscriptions.add(subscription, handler)
     return subscription
 
 
 def unsubscribe(subscription_id: UUID):
-    subscriptions = list(filter(lambda sub: sub.id == subscription_id, _connection_handlers.keys()))
-    for subscription in subscriptions:
-        _connection_handlers.pop(subscription)
+    _subscriptions.remove(subscription_id)
 
 
-async def handle_incoming_message(msg: str, event_handler: EventHandler,
-                                  subscription_callback: SubscriptionCallback) -> str:
+async def handle_incoming_message(msg: str | bytes, codec: Codec, event_handler: EventHandler,
+                                  delivery_handler: EventHandler,
+                                  subscription_callback: SubscriptionCallback) -> Dict:
     try:
-        raw_data = json.loads(msg)
+        raw_data = decode_frame(msg, codec)
         intent = str(raw_data.get("intent")).lower()
         if intent == "subscribe":
-            return await handle_incoming_subscribe_intent(raw_data, event_handler,
+            return await handle_incoming_subscribe_intent(raw_data, delivery_handler,
                                                           subscription_callback)
         elif intent == "unsubscribe":
             return await handle_incoming_unsubscribe_intent(raw_data)
         event_data = raw_data.get("event")
         if event_data is not None:
-            res = await handle_incoming_event(event_data, event_handler)
-            return res if res is not None else json.dumps({"success": True})
-        return json.dumps({"success": False, "error": "Instructions unclear."})
+            return await handle_incoming_event(event_data, event_handler)
+        return {"success": False, "error": "Instructions unclear."}
     except Exception as e:
         logger.exception(e)
-        return json.dumps({"success": False, "error": str(e)})
+        return {"success": False, "error": str(e)}
 
 
 async def handle_incoming_subscribe_intent(data: dict, event_handler: EventHandler,
-                                           subscription_callback: SubscriptionCallback) -> str:
+                                           subscription_callback: SubscriptionCallback) -> Dict:
     assert isinstance(data, dict)
     sub_type = SubscriberType(str(data.get("subscriber_type")).lower())
     event_type = EventType(str(data.get("event_type")).lower())
     id = data.get("id")
     sub = subscribe(sub_type, event_type, event_handler, id)
     await subscription_callback(sub)
-    return json.dumps({"success": True, "subscription": sub.to_dict()})
+    # Parked events are dispatched by the queue worker, i.e. after this response has been sent
+    flush_mailbox(sub.subscriber)
+    return {"success": True, "subscription": sub.to_dict()}
 
 
-async def handle_incoming_unsubscribe_intent(data: dict):
+async def handle_incoming_unsubscribe_intent(data: dict) -> Dict:
     try:
         unsubscribe(UUID(data["sub_id"]))
         res = {"success": True}
     except KeyError as e:
         print(e)
         res = {"success": False, "error": "Expected 'subscription_id' parameter."}
-    return json.dumps(res)
+    return res
 
 
-async def handle_incoming_event(data: dict, event_handler: EventHandler):
-    type = EventType(data["type"])
-    rec = data.get("recipient")
-    if rec is not None:
-        rec = Recipient(rec["subscriber_type"], rec.get("id"))
-    message = data["message"]
-    ephemeral = data.get("ephemeral", True)
-    event = Event(type, rec, message, ephemeral)
+async def handle_incoming_event(data: dict, event_handler: EventHandler) -> Dict:
+    event = Event.from_dict(data)
     try:
         await event_handler(event)
+    except LoginRejected as e:
+        return {"success": False, "error": str(e)}
     except Exception as e:
         logger.exception(e)
-        return json.dumps({"success": False, "error": str(e)})
+        return {"success": False, "error": str(e)}
     queue(event)
-    return json.dumps({"success": True, "event": event.to_dict()})
-
-
-async def handle_agent_login_event(event: Event,
-                                   ws: websockets.WebSocketServerProtocol) -> Agent | None:
-    close_code: int | None = None
-    agent_id = event.message["agent_id"]
-    agent: Agent | None = await Agent.get_or_none(id=agent_id)
-    if agent is None:
-        error = f"Agent '{agent_id}' not found"
-        close_code = 4004
-    elif agent.connected:
-        error = "Agent is already connected."
-        close_code = 4003
-    else:
-        agent.last_connection_start = datetime.datetime.now(tz=datetime.timezone.utc)
-        agent.connected = True
-        agent.connection_interrupted = False
-        agent.connection_from_ip_address = ws.request_headers.get(
-            "x-forwarded-for", ws.remote_address[0] if isinstance(ws.remote_address, tuple)
-                                                       and len(ws.remote_address) > 0
-            else str(ws.remote_address))
-        await agent.save()
-        await ws.send(json.dumps({"success": True}))
-        return agent
-    if close_code is not None:
-        await ws.close(close_code, error)
+    return {"success": True, "event": event.to_dict()}
+
+
+class LoginRejected(Exception):
+    pass
+
+
+class LoginAdmission:
+    """Token bucket pacing agent logins. Rejected agents get a jittered hint on when to retry,
+    spread over the time it takes to admit everyone currently waiting."""
+    rate: float
+    burst: int
+
+    def __init__(self, rate: float = LOGIN_RATE, burst: int = LOGIN_BURST):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._waiting = 0
+
+    def try_admit(self) -> bool:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= self.burst:
+            self._waiting = 0
+        if self._tokens >= 1:
+            self._tokens -= 1
+            self._waiting = max(0, self._waiting - 1)
+            return True
+        self._waiting += 1
+        return False
+
+    def retry_hint(self) -> float:
+        return round(random.uniform(1, max(2.0, self._waiting / self.rate)), 2)
+
+
+class LoginBatch:
+    """Coalesces the bookkeeping of agent logins, loading and updating the agents of all logins
+    within `delay` and loading their pending commands with one query each."""
+    _pending: List[Tuple[str, str, asyncio.Future]]
+
+    def __init__(self, delay: float = LOGIN_BATCH_DELAY, size: int = LOGIN_BATCH_SIZE):
+        self.delay = delay
+        self.size = size
+        self._pending = []
+        self._flush_handle: asyncio.TimerHandle | None = None
+
+    async def login(self, agent_id: str, ip_address: str) \
+            -> Tuple[Agent, List[PendingAgentCommand]] | None:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((agent_id, ip_address, future))
+        if len(self._pending) >= self.size:
+            self._schedule_flush(0)
+        elif self._flush_handle is None:
+            self._schedule_flush(self.delay)
+        return await future
+
+    def _schedule_flush(self, delay: float):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        self._flush_handle = asyncio.get_running_loop().call_later(
+            delay, lambda: asyncio.create_task(self._flush()))
+
+    async def _flush(self):
+        # Logins cancelled while waiting, e.g. because the agent disconnected, are dropped
+        batch = [login for login in self._pending if not login[2].done()]
+        self._pending = []
+        self._flush_handle = None
+        try:
+            agents = {str(agent.id): agent for agent in
+                      await Agent.filter(id__in=[agent_id for agent_id, _, _ in batch])}
+            now = datetime.datetime.now(tz=datetime.timezone.utc)
+            for agent_id, ip_address, _ in batch:
+                agent = agents.get(agent_id)
+                if agent is not None:
+                    agent.last_connection_start = now
+                    agent.connected = True
+                    agent.connection_interrupted = False
+                    agent.connection_from_ip_address = ip_address
+            commands = defaultdict(list)
+            if len(agents) > 0:
+                await Agent.bulk_update(list(agents.values()),
+                                        ["last_connection_start", "connected",
+                                         "connection_interrupted", "connection_from_ip_address"])
+                for command in await PendingAgentCommand.filter(
+                        agent_id__in=list(agents)).order_by("id"):
+                    commands[str(command.agent_id)].append(command)
+            for agent_id, _, future in batch:
+                if future.done():
+                    continue
+                agent = agents.get(agent_id)
+                future.set_result((agent, commands[agent_id]) if agent is not None else None)
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+
+login_admission = LoginAdmission()
+_login_batch = LoginBatch()
+
+
+async def _reject_login(ws: websockets.WebSocketServerProtocol, close_code: int, error: str,
+                        retry_after: float | None = None):
+    if retry_after is not None:
+        await ws.send(json.dumps({"success": False, "error": error, "retry_after": retry_after}))
+    await ws.close(close_code, error)
+    raise LoginRejected(error)
+
+
+async def handle_agent_login_event(event: Event, ws: websockets.WebSocketServerProtocol,
+                                   codec: Codec = json_codec) -> Agent:
+    agent_id = str(event.message["agent_id"])
+    if not login_admission.try_admit():
+        await _reject_login(ws, 1013, "Too many agents are logging in, try again later.",
+                            login_admission.retry_hint())
+    try:
+        agent_id = str(UUID(agent_id))
+    except ValueError:
+        await _reject_login(ws, 4004, f"Agent '{agent_id}' not found")
+    # Connections are only accepted by this process, so the in-memory set is the source of truth
+    if agent_id in _logged_in_agents:
+        await _reject_login(ws, 4003, "Agent is already connected.")
+    _logged_in_agents.add(agent_id)
+    ip_address = ws.request_headers.get(
+        "x-forwarded-for", ws.remote_address[0] if isinstance(ws.remote_address, tuple)
+                                                   and len(ws.remote_address) > 0
+        else str(ws.remote_address))
+    try:
+        login = await _login_batch.login(agent_id, ip_address)
+    except BaseException:
+        _logged_in_agents.discard(agent_id)
+        raise
+    if login is None:
+        _logged_in_agents.discard(agent_id)
+        await _reject_login(ws, 4004, f"Agent '{agent_id}' not found")
+    agent, commands = login
+    try:
+        # The encoding is switched after this message
+        await ws.send(json.dumps({"success": True, "encoding": codec.name}))
+        await replay_pending_commands(agent, commands)
+    except ConnectionClosed as error:
+        # Closed while the login was batched, the connection handler doesn't know the agent yet
+        await handle_agent_disconnect(agent, error)
+        raise
+    return agent
 
 
 async def handle_agent_software_status_update_event(event: Event, agent: Agent | None):
@@ -301,6 +748,7 @@ async def handle_agent_software_status_update_event(event: Event, agent: Agent |
     if software is None:
         raise ValueError(f"Software '{software_id}' not found.")
     assert (await software.agent).id == agent.id, "This software isn't installed on this agent."
+    await acknowledge_pending_command(software_id, event.message.get("command"))
     was_uninstalling = software.uninstalling
     valid_fields = {"corrupt", "installed_version", "installing", "uninstalling"}
     if set(status.keys()).issubset(valid_fields):
@@ -323,6 +771,8 @@ async def handle_agent_software_status_update_event(event: Event, agent: Agent |
 
 
 async def handle_agent_disconnect(agent: Agent, error: ConnectionClosed):
+    _logged_in_agents.discard(str(agent.id))
+    _discard_durable_mail(Recipient(SubscriberType.AGENT, str(agent.id)))
     agent.connected = False
     agent.last_connection_end = datetime.datetime.now(tz=datetime.timezone.utc)
     if isinstance(error, ConnectionClosedError):
@@ -333,20 +783,76 @@ async def handle_agent_disconnect(agent: Agent, error: ConnectionClosed):
     await _notify(event)
 
 
-def cancel_event(type: EventType, recipient: Recipient):
-    cancellation = Cancellation(type, recipient)
-    _cancellations.add(cancellation)
+def cancel_event(recipient: Recipient, software_id: str):
+    """Cancel all commands for the software that have been queued so far."""
+    _bus.cancel(recipient, software_id)
+
+
+class Outbox:
+    """Bounded buffer of outgoing messages of a single connection. Messages are sent by a separate
+    task, so that a slow connection only delays its own messages."""
+    _messages: asyncio.Queue[str | bytes]
+
+    def __init__(self, ws: websockets.WebSocketServerProtocol, size: int = OUTBOX_SIZE):
+        self._ws = ws
+        self._messages = asyncio.Queue(size)
+        self._task = asyncio.create_task(self._run())
+
+    def offer(self, message: str | bytes) -> bool:
+        """Queue a message without waiting, returns False if it can't be sent."""
+        if self._task.done():
+            return False
+        try:
+            self._messages.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            logger.warning("Outbox of %s is full, dropping message", self._ws.remote_address)
+            return False
+
+    async def put(self, message: str | bytes):
+        """Queue a message, waiting for space. Raises `ConnectionClosed` if the connection stopped
+        being written to, e.g. after a send timeout."""
+        if not self._task.done():
+            put = asyncio.ensure_future(self._messages.put(message))
+            await asyncio.wait([put, self._task], return_when=asyncio.FIRST_COMPLETED)
+            if put.done():
+                return
+            put.cancel()
+        raise ConnectionClosedError(self._ws.close_rcvd, self._ws.close_sent)
+
+    async def _run(self):
+        while True:
+            message = await self._messages.get()
+            try:
+                await asyncio.wait_for(self._ws.send(message), SEND_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning("Sending to %s timed out, closing connection",
+                               self._ws.remote_address)
+                await self._ws.close(1011, "Send timeout")
+                return
+            except ConnectionClosed:
+                return
+
+    def close(self):
+        self._task.cancel()
 
 
 async def websocket_handler(ws: websockets.WebSocketServerProtocol):
     async def event_handler(event: Event):
-        nonlocal agent
+        nonlocal agent, codec
         match event.type:
             case EventType.AGENT_LOGIN:
-                agent = await handle_agent_login_event(event, ws)
+                login_codec = negotiate_codec(event.message.get("encodings"))
+                agent = await handle_agent_login_event(event, ws, login_codec)
+                codec = login_codec
             case EventType.AGENT_SOFTWARE_STATUS_UPDATE:
                 await handle_agent_software_status_update_event(event, agent)
-        await ws.send(json.dumps({"event": event.to_dict()}))
+        # Compact encodings leave out the echo as the response already contains the event
+        if codec is json_codec:
+            outbox.offer(codec.encode({"event": event.to_dict()}))
+
+    async def deliver(event: Event):
+        return outbox.offer(codec.encode({"event": event.to_dict()}))
 
     async def subscription_callback(subscription: Subscription):
         nonlocal subs
@@ -354,6 +860,8 @@ async def websocket_handler(ws: websockets.WebSocketServerProtocol):
 
     subs: List[UUID] = []
     agent: Agent | None = None
+    codec: Codec = json_codec
+    outbox = Outbox(ws)
     try:
         while True:
             if ws.closed:
@@ -361,79 +869,117 @@ async def websocket_handler(ws: websockets.WebSocketServerProtocol):
                     raise ConnectionClosedError(ws.close_rcvd, ws.close_sent)
                 raise ConnectionClosedOK(ws.close_rcvd, ws.close_sent)
             msg = await ws.recv()
-            res = await handle_incoming_message(msg, event_handler, subscription_callback)
-            await ws.send(res)
+            res = await handle_incoming_message(msg, codec, event_handler, deliver,
+                                                subscription_callback)
+            await outbox.put(codec.encode(res))
     except (ConnectionClosedOK, ConnectionClosedError) as error:
         # Unsubscribe to prevent memory leak
         for id in subs:
             unsubscribe(id)
         if agent is not None:
             await handle_agent_disconnect(agent, error)
+    finally:
+        outbox.close()
 
 
-async def process_queue():
-    logger.debug("Processing queue: %s unfinished", _event_queue.unfinished_tasks)
-    failed_notifications = []
-    while not _event_queue.empty():
-        event = _event_queue.get(block=False)
-        cancellation = Cancellation(event.type, event.recipient)
-        if cancellation in _cancellations:
-            logger.debug("Skipping event %s due to cancellation", event)
-            _cancellations.remove(cancellation)
-            _event_queue.task_done()
-            continue
+def _retry_later(event: Event):
+    event.attempts += 1
+    delay = min(RETRY_BASE_DELAY * 2 ** (event.attempts - 1), RETRY_MAX_DELAY)
+    logger.debug("Retrying event %s in %ss", event, delay)
+    asyncio.get_running_loop().call_later(delay, _put, event)
+
+
+async def _dispatch(event: Event):
+    if _is_cancelled(event):
+        logger.debug("Skipping event %s due to cancellation", event)
+        _finish(event)
+        return
+    try:
+        success = await _notify(event)
+    except ConnectionClosed:
+        success = False
+    if success:
+        if event.queued_at is not None:
+            delivery_latency.observe(time.monotonic() - event.queued_at)
+    elif not event.ephemeral:
+        if event.durable and event.recipient.id not in _logged_in_agents:
+            # Persisted, will be replayed once the agent logs in
+            logger.debug("Agent offline, deferring event %s until next login", event)
+        elif not has_subscribers(event):
+            logger.debug("No subscribers, parking event %s", event)
+            _park(event)
+            return
+        else:
+            _retry_later(event)
+            return
+    _finish(event)
+
+
+async def _run_dispatch_task(event_queue: asyncio.Queue[Event]):
+    while True:
+        event = await event_queue.get()
         try:
-            success = await _notify(event)
-        except ConnectionClosed:
-            success = False
-        if not success and not event.ephemeral:
-            failed_notifications.append(event)
-        _event_queue.task_done()
-    for event in failed_notifications:
-        _event_queue.put(event)
+            await _dispatch(event)
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            event_queue.task_done()
 
 
 async def run_websocket_server():
-    agents = await Agent.filter(connected=True).all()
-    for agent in agents:
-        agent.connected = False
-        await agent.save()
-    async with websockets.serve(websocket_handler, "0.0.0.0", 8001):
+    await Agent.filter(connected=True).update(connected=False)
+    async with websockets.serve(websocket_handler, "0.0.0.0", 8001, compression="deflate"):
         logger.info("Started event server")
         await asyncio.Future()
 
 
-async def run_queue_worker():
-    logger.info("Running notify queue worker")
-    while True:
-        await process_queue()
-        await asyncio.sleep(1)
+async def run_queue_worker(tasks: int = DEFAULT_DISPATCH_TASKS):
+    global _event_queues
+    logger.info("Running notify queue worker with %s dispatch tasks", tasks)
+    # Move events queued before the worker started over to the final set of queues
+    pending = [queue.get_nowait() for queue in _event_queues for _ in range(queue.qsize())]
+    _event_queues = [asyncio.Queue() for _ in range(tasks)]
+    for event in pending:
+        _put(event)
+    await asyncio.gather(*(_run_dispatch_task(queue) for queue in _event_queues))
+
+
+async def run_hub(dispatch_tasks: int = DEFAULT_DISPATCH_TASKS):
+    await asyncio.gather(run_websocket_server(), run_queue_worker(dispatch_tasks),
+                         run_event_worker())
 
 
 async def get_user_reload_event(event: Event):
-    agent_id: str | UUID | None = None
+    user_id: UUID | None = None
     match event.type:
         case EventType.AGENT_INIT | EventType.AGENT_LOGIN | EventType.WS_DISCONNECT:
-            agent_id = event.message["agent_id"]
+            user_id = await Agent.filter(id=event.message["agent_id"]).first().values_list(
+                "user_id", flat=True)
         case EventType.AGENT_SOFTWARE_STATUS_UPDATE:
-            software_id = event.message["software_id"]
-            software = await AgentSoftware.get_or_none(id=software_id)
-            agent_id = (await software.agent).id if software is not None else None
-    if agent_id is None:
-        return
-    agent: Agent | None = await Agent.get_or_none(id=agent_id)
-    if agent is None:
+            user_id = await AgentSoftware.filter(id=event.message["software_id"]).first() \
+                .values_list("agent__user_id", flat=True)
+    if user_id is None:
         return
-    user_id = str((await agent.user).id)
-    recipient = Recipient(SubscriberType.USER, user_id)
+    recipient = Recipient(SubscriberType.USER, str(user_id))
     return Event(EventType.RELOAD, recipient, {"paths": ["/home/agent/software", "/agent/list"]})
 
 
 async def run_event_worker():
+    pending_reloads: Set[RecipientKey] = set()
+
+    def flush_reload(event: Event):
+        pending_reloads.discard(_recipient_key(event.recipient))
+        queue(event)
+
     async def handler(event: Event):
         event = await get_user_reload_event(event)
-        if event is not None:
-            await _notify(event)
+        if event is None:
+            return
+        # A reconnecting fleet would otherwise reload the user's pages once per agent
+        key = _recipient_key(event.recipient)
+        if key not in pending_reloads:
+            pending_reloads.add(key)
+            asyncio.get_running_loop().call_later(RELOAD_COALESCE_DELAY, flush_reload, event)
 
     logger.info("Running event worker")
     subscribe(SubscriberType.SERVER, EventType.AGENT_INIT, handler)
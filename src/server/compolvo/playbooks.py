@@ -0,0 +1,60 @@
+import asyncio
+from typing import Dict, Tuple
+
+import httpx
+from sanic import Request, HTTPResponse, raw
+from sanic.log import logger
+
+MANIFEST_MAX_AGE = 300
+FETCH_TIMEOUT = 10
+# The name generate_playbooks.py gives the playbook uninstalling a service
+UNINSTALL_PLAYBOOK = "uninstall"
+
+
+class PlaybookManifest:
+    """The manifest written by generate_playbooks.py, fetched from where the playbooks are hosted
+    and revalidated with its ETag every `MANIFEST_MAX_AGE` seconds by `run`. Requests only read the
+    last known manifest, which is kept if it can't be fetched."""
+    url: str | None
+
+    def __init__(self, url: str | None):
+        self.url = url
+        self._body: bytes | None = None
+        self._etag: str | None = None
+        self._hashes: Dict[Tuple[str, str], str] = {}
+
+    async def run(self):
+        if self.url is None:
+            return
+        while True:
+            await self._refresh()
+            await asyncio.sleep(MANIFEST_MAX_AGE)
+
+    async def _refresh(self):
+        headers = {} if self._etag is None else {"If-None-Match": self._etag}
+        try:
+            async with httpx.AsyncClient(timeout=FETCH_TIMEOUT) as client:
+                response = await client.get(self.url, headers=headers)
+            if response.status_code != 304:
+                response.raise_for_status()
+                hashes = {(entry["service"], entry["version"]): entry["sha256"] for entry in
+                          response.json()["playbooks"]}
+                self._body, self._etag, self._hashes = response.content, \
+                    response.headers.get("ETag"), hashes
+        except (httpx.HTTPError, ValueError, KeyError) as e:
+            logger.warning("Couldn't fetch playbook manifest from %s: %s", self.url, e)
+
+    def sha256(self, service: str, version: str) -> str | None:
+        """The hash of the playbook installing `version` of the service, if known."""
+        return self._hashes.get((service, version))
+
+    def uninstall_sha256(self, service: str) -> str | None:
+        return self._hashes.get((service, UNINSTALL_PLAYBOOK))
+
+    def response(self, request: Request) -> HTTPResponse:
+        if self._body is None:
+            return HTTPResponse("No playbook manifest available.", status=404)
+        headers = {} if self._etag is None else {"ETag": self._etag}
+        if self._etag is not None and request.headers.get("if-none-match") == self._etag:
+            return HTTPResponse(status=304, headers=headers)
+        return raw(self._body, content_type="application/json", headers=headers)
@@ -1,5 +1,6 @@
 import datetime
 import hashlib
+import os
 import re
 import secrets
 import string
@@ -71,3 +72,12 @@ def test_email(email: str) -> bool:
     pattern = r"(?:[a-z0-9!#$%&'*+/=?^_`{|}~-]+(?:\.[a-z0-9!#$%&'*+/=?^_`{|}~-]+)*|\"(?:[\x01-\x08\x0b\x0c\x0e-\x1f\x21\x23-\x5b\x5d-\x7f]|\\[\x01-\x09\x0b\x0c\x0e-\x7f])*\")@(?:(?:[a-z0-9](?:[a-z0-9-]*[a-z0-9])?\.)+[a-z0-9](?:[a-z0-9-]*[a-z0-9])?|\[(?:(?:(2(5[0-5]|[0-4][0-9])|1[0-9][0-9]|[1-9]?[0-9]))\.){3}(?:(2(5[0-5]|[0-4][0-9])|1[0-9][0-9]|[1-9]?[0-9])|[a-z0-9-]*[a-z0-9]:(?:[\x01-\x08\x0b\x0c\x0e-\x1f\x21-\x5a\x53-\x7f]|\\[\x01-\x09\x0b\x0c\x0e-\x7f])+)\])"
     match = re.match(pattern, email)
     return match is not None
+
+
+def db_url_from_env() -> str:
+    db_hostname = os.environ["DB_HOSTNAME"]
+    db_username = os.environ["DB_USERNAME"]
+    db_password = os.environ["DB_PASSWORD"]
+    db_database = os.environ["DB_DATABASE"]
+    db_port = os.environ["DB_PORT"]
+    return f'mysql://{db_username}:{db_password}@{db_hostname}:{db_port}/{db_database}'
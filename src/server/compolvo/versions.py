@@ -0,0 +1,58 @@
+import asyncio
+from typing import Dict, Tuple, Iterable
+from uuid import UUID
+
+from compolvo.models import PackageManagerAvailableVersion
+
+VersionKey = Tuple[str, str]
+
+
+class LatestVersionIndex:
+    """(service id, operating system id) -> latest version, loaded with a single query and kept
+    until `invalidate` is called."""
+    version: int
+
+    def __init__(self):
+        self.version = 0
+        self._versions: Dict[VersionKey, str] | None = None
+        self._lock = asyncio.Lock()
+
+    def invalidate(self):
+        self.version += 1
+        self._versions = None
+
+    async def _get_versions(self) -> Dict[VersionKey, str]:
+        versions = self._versions
+        if versions is not None:
+            return versions
+        async with self._lock:
+            if self._versions is not None:
+                return self._versions
+            version = self.version
+            rows = await PackageManagerAvailableVersion.filter(latest=True).values_list(
+                "service_id", "operating_system_id", "version")
+            versions = {}
+            for service_id, os_id, latest_version in rows:
+                versions.setdefault((str(service_id), str(os_id)), latest_version)
+            # Don't keep an index that was invalidated while it was being loaded
+            if version == self.version:
+                self._versions = versions
+            return versions
+
+    async def get(self, service_id: UUID | str, os_id: UUID | str | None) -> str | None:
+        if os_id is None:
+            return None
+        return (await self._get_versions()).get((str(service_id), str(os_id)))
+
+    async def get_many(self, service_and_os_ids: Iterable[Tuple[UUID | str, UUID | str | None]]) \
+            -> Dict[VersionKey, str]:
+        versions = await self._get_versions()
+        latest_versions = {}
+        for service_id, os_id in service_and_os_ids:
+            key = (str(service_id), str(os_id))
+            if os_id is not None and key in versions:
+                latest_versions[key] = versions[key]
+        return latest_versions
+
+
+latest_version_index = LatestVersionIndex()
@@ -0,0 +1,30 @@
+"""Runs the notify gateway (WebSocket server, event dispatcher and event worker) as its own
+process. Start the API with NOTIFY_GATEWAY=external and the same NOTIFY_BUS_PATH, it then
+publishes its events to this process over the Unix socket."""
+import asyncio
+import logging
+import os
+
+from compolvo import notify
+from compolvo.bus import UnixSocketBus
+from compolvo.utils import db_url_from_env
+from tortoise import Tortoise
+
+NOTIFY_BUS_PATH = os.environ["NOTIFY_BUS_PATH"]
+NOTIFY_DISPATCH_TASKS = int(os.environ.get("NOTIFY_DISPATCH_TASKS", notify.DEFAULT_DISPATCH_TASKS))
+
+
+async def main():
+    await Tortoise.init(db_url=db_url_from_env(), modules={"models": ["compolvo.models"]})
+    await Tortoise.generate_schemas()
+    bus = UnixSocketBus(NOTIFY_BUS_PATH, hub=True)
+    notify.set_bus(bus)
+    try:
+        await bus.run(lambda: notify.run_hub(NOTIFY_DISPATCH_TASKS))
+    finally:
+        await Tortoise.close_connections()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
@@ -16,11 +16,13 @@ from sanic_openapi import openapi
 from tortoise.contrib.sanic import register_tortoise
 from tortoise.exceptions import IntegrityError
 from tortoise.expressions import F
-from tortoise.functions import Coalesce
 
 from compolvo import cors
 from compolvo import notify
 from compolvo import options
+from compolvo.catalog import build_service_catalog, catalog_cache, cached_catalog_response
+from compolvo.versions import latest_version_index
+from compolvo.playbooks import PlaybookManifest
 from compolvo.decorators import patch_endpoint, delete_endpoint, get_endpoint, protected, \
     requires_payment_details, requires_stripe_customer
 from compolvo.models import Agent, AgentSoftware, Serializable, PackageManager, \
@@ -28,10 +30,12 @@ from compolvo.models import Agent, AgentSoftware, Serializable, PackageManager,
     BillingCycle, BillingCycleType, ServerStatus
 from compolvo.models import Service, OperatingSystem, Tag, UserRole, User, License, \
     ServiceOffering, ServicePlan
-from compolvo.notify import Event, Recipient, EventType, SubscriberType, cancel_event
+from compolvo.bus import UnixSocketBus
+from compolvo.notify import Event, Recipient, EventType, SubscriberType, cancel_event, \
+    InProcessBus
 from compolvo.utils import verify_password, check_token, Unauthorized, BadRequest, NotFound, \
     hash_password, generate_secret, test_email, \
-    user_has_roles
+    user_has_roles, db_url_from_env
 
 HTTP_HEADER_DATE_FORMAT = "%a, %d %b %Y %H:%M:%S GMT"
 
@@ -44,21 +48,32 @@ app.config.SESSION_TIMEOUT = 60 * 30
 
 SERVER_ID = os.environ["SERVER_ID"]
 STRIPE_API_KEY = os.environ.get("STRIPE_API_KEY")
+NOTIFY_DISPATCH_TASKS = int(os.environ.get("NOTIFY_DISPATCH_TASKS", notify.DEFAULT_DISPATCH_TASKS))
+# Required when running more than one worker, all workers need to use the same path
+NOTIFY_BUS_PATH = os.environ.get("NOTIFY_BUS_PATH")
+# "embedded" runs the notify gateway in one of the workers, "external" expects gateway.py to run it
+NOTIFY_GATEWAY = os.environ.get("NOTIFY_GATEWAY", "embedded")
+SERVER_WORKERS = int(os.environ.get("SERVER_WORKERS", 1))
+# Sanic names its worker processes Sanic-Server-<number>-<restarts>
+FIRST_WORKER_PREFIX = "Sanic-Server-0-"
+if NOTIFY_GATEWAY not in ("embedded", "external"):
+    raise ValueError(f"Unknown NOTIFY_GATEWAY {NOTIFY_GATEWAY!r}, expected embedded or external.")
+if NOTIFY_GATEWAY == "external" and NOTIFY_BUS_PATH is None:
+    raise ValueError("NOTIFY_BUS_PATH is required with an external notify gateway.")
+if SERVER_WORKERS > 1 and NOTIFY_BUS_PATH is None:
+    # Events and cache invalidations wouldn't reach the other workers
+    raise ValueError("NOTIFY_BUS_PATH is required when running more than one worker.")
+# e.g. http://reverse-proxy:8080/ansible/playbooks/manifest.json, commands carry no hashes if unset
+PLAYBOOK_MANIFEST_URL = os.environ.get("PLAYBOOK_MANIFEST_URL") or None
 if STRIPE_API_KEY == "":  # e.g. when docker compose doesn't find the key in the .env file
     STRIPE_API_KEY = None
 if STRIPE_API_KEY is not None:
     stripe.api_key = STRIPE_API_KEY
 
-db_hostname = os.environ[
-    "DB_HOSTNAME"]
-db_username = os.environ["DB_USERNAME"]
-db_password = os.environ["DB_PASSWORD"]
-db_database = os.environ["DB_DATABASE"]
-db_port = os.environ["DB_PORT"]
+playbook_manifest = PlaybookManifest(PLAYBOOK_MANIFEST_URL)
 
-register_tortoise(app,
-                  db_url=f'mysql://{db_username}:{db_password}@{db_hostname}:{db_port}/{db_database}',
-                  modules={'models': ['compolvo.models']}, generate_schemas=True)
+register_tortoise(app, db_url=db_url_from_env(), modules={'models': ['compolvo.models']},
+                  generate_schemas=True)
 
 user = Blueprint("user", url_prefix="/api/user")
 service = Blueprint("service", url_prefix="/api/service")
@@ -108,6 +123,8 @@ async def db_setup(request, user: User):
         await set_up_demo_db(user, services=services,
                              service_offerings=service_offerings,
                              service_plans=service_plans)
+        notify.invalidate_cache("catalog")
+        notify.invalidate_cache("latest_versions")
         return text("Created.", status=201)
     return HTTPResponse(status=204)
 
@@ -414,35 +431,29 @@ async def set_up_demo_db(user: User, services: bool = False,
                 )
 
 
+def is_first_worker() -> bool:
+    """Whether this process runs the jobs that must only run once, like seeding the database and
+    the schedules. A worker restarted by Sanic keeps its number, so they never run concurrently."""
+    name = os.environ.get("SANIC_WORKER_NAME")
+    return name is None or name.startswith(FIRST_WORKER_PREFIX)
+
+
 @app.listener("before_server_start")
 async def test_user(app):
     options.setup_options(app)
+    if not is_first_worker():
+        return
     await create_user("test@example.com", "Test", "user", "Test12345!", None, True)
     await create_user("admin@example.com", "Admin", "Istrator", "admin", UserRole.Role.ADMIN, True)
 
 
 @app.listener("after_server_start")
 async def after_server_start(app):
+    if not is_first_worker():
+        return
     await update_server_status(running=True)
-
-
-async def get_latest_version(service: Service, os: OperatingSystem) -> str | None:
-    query = (
-        Service
-        .filter(
-            id=service.id,
-            available_versions__latest=True,
-            available_versions__operating_system=os
-        )
-        .annotate(
-            version=Coalesce("available_versions__version")
-        )
-        .values("version")
-    )
-    results = await query
-    if results:
-        return results[0]["version"]
-    return None
+    app.add_task(run_schedules())
+    app.add_task(perform_billing_maintenance())
 
 
 @app.get("/api/login")
@@ -506,7 +517,7 @@ async def admin(request, user):
 
 @user.get("/")
 @protected()
-@get_endpoint(User, {UserRole.Role.ADMIN})
+@get_endpoint(User, {UserRole.Role.ADMIN}, stream=True)
 async def get_users(request, users, user):
     pass
 
@@ -587,41 +598,27 @@ async def delete_own_user(request, user: User):
 
 
 @service.get("/")
-@get_endpoint(Service)
 @openapi.summary("Get all services")
 @openapi.description(
     "By default, returns a JSON list of all services including tags. If a `id` is specified in the query args, only that specific service will be returned (provided it is found).")
 # @openapi.response(200, {"application/json": Union[List[Service], Service]})
-async def get_services(request, services):
-    async def expand(svc: Service) -> dict:
-        query = (
-            Service
-            .filter(id=svc.id)
-            .annotate(
-                os_id=Coalesce("available_versions__operating_system__id")
-                # just so this field is resolved, as pure strings aren't supported
-            )
-            .filter(os_id__isnull=False)
-            .values("os_id")
-        )
-        results = await query
-        oses = [os.get("os_id") for os in results]
-
-        return {
-            **await svc.to_dict(),
-            "tags": [await tag.to_dict() for tag in await svc.tags],
-            "offerings": [await offering.to_dict() for offering in
-                          await ServiceOffering.filter(service=svc).order_by(
-                              "duration_days").all()],
-            "operating_systems": oses,
-        }
+async def get_services(request):
+    if len(request.args) == 0:
+        return await cached_catalog_response(request)
+    return await get_services_from_db(request)
+
+
+@get_endpoint(Service, serialize=build_service_catalog)
+async def get_services_from_db(request, services):
+    pass
 
-    if isinstance(services, list):
-        return json(
-            [await expand(svc) for
-             svc in
-             services])
-    return json(await expand(services))
+
+@service.get("/playbooks")
+@openapi.summary("Get the playbook manifest")
+@openapi.description(
+    "Returns the manifest of all generated playbooks with their SHA-256, so agents can verify and prefetch them.")
+async def get_playbook_manifest(request):
+    return playbook_manifest.response(request)
 
 
 @service.post("/")
@@ -642,6 +639,7 @@ async def create_service(request, user):
         await service.operating_systems.add(
             *await OperatingSystem.filter(id__in=oses).all()
         )
+    notify.invalidate_cache("catalog")
     return await service.json()
 
 
@@ -649,14 +647,15 @@ async def create_service(request, user):
 @protected({UserRole.Role.ADMIN})
 @patch_endpoint(Service)
 async def update_service(request, svc, user):
-    pass
+    notify.invalidate_cache("catalog")
 
 
 @service.delete("/")
 @protected({UserRole.Role.ADMIN})
 @delete_endpoint(Service)
 async def delete_service(request, svc, user):
-    pass
+    notify.invalidate_cache("catalog")
+    notify.invalidate_cache("latest_versions")
 
 
 @service.delete("/bulk")
@@ -666,6 +665,8 @@ async def delete_services_bulk(request, user):
         raise BadRequest("No services provided.")
     ids = request.json.get("services", [])
     await Service.filter(id__in=ids).delete()
+    notify.invalidate_cache("catalog")
+    notify.invalidate_cache("latest_versions")
     return json({"deleted": ids})
 
 
@@ -690,6 +691,7 @@ async def create_service_offering(request, user):
             duration_days=request.json["duration_days"],
             service=svc
         )
+        notify.invalidate_cache("catalog")
         return await offering.json()
     except KeyError:
         raise BadRequest(
@@ -700,19 +702,19 @@ async def create_service_offering(request, user):
 @protected({UserRole.Role.ADMIN})
 @patch_endpoint(ServiceOffering)
 async def update_service_offering(request, offering, user):
-    pass
+    notify.invalidate_cache("catalog")
 
 
 @service_offering.delete("/")
 @protected({UserRole.Role.ADMIN})
 @delete_endpoint(ServiceOffering)
 async def delete_service_offering(request, offering, user):
-    pass
+    notify.invalidate_cache("catalog")
 
 
 @service_plan.get("/all")
 @protected()
-@get_endpoint(ServicePlan, {UserRole.Role.ADMIN})
+@get_endpoint(ServicePlan, {UserRole.Role.ADMIN}, stream=True)
 async def get_service_plans(request, plans, user):
     pass
 
@@ -836,6 +838,7 @@ async def create_tag(request, user):
     try:
         label = request.json["label"]
         tag = await Tag.create(label=label)
+        notify.invalidate_cache("catalog")
         return await tag.json()
     except KeyError:
         raise BadRequest("Missing parameters. Requires: label.")
@@ -845,14 +848,14 @@ async def create_tag(request, user):
 @protected({UserRole.Role.ADMIN})
 @patch_endpoint(Tag)
 async def update_tag(request, tag, user):
-    pass
+    notify.invalidate_cache("catalog")
 
 
 @tag.delete("/")
 @protected({UserRole.Role.ADMIN})
 @delete_endpoint(Tag)
 async def delete_tag(request, tag, user):
-    pass
+    notify.invalidate_cache("catalog")
 
 
 @service.post("/tag")
@@ -860,6 +863,7 @@ async def delete_tag(request, tag, user):
 async def associate_tag_with_service(request, user):
     svc, tag = await _get_svc_and_tag_from_request(request)
     await svc.tags.add(tag)
+    notify.invalidate_cache("catalog")
     return HTTPResponse(status=204)
 
 
@@ -868,6 +872,7 @@ async def associate_tag_with_service(request, user):
 async def deassociate_tag_with_service(request, user):
     svc, tag = await _get_svc_and_tag_from_request(request)
     await svc.tags.remove(tag)
+    notify.invalidate_cache("catalog")
     return HTTPResponse(status=204)
 
 
@@ -957,7 +962,7 @@ async def agent_init(request):
 
 @agent.get("/all")
 @protected({UserRole.Role.ADMIN})
-@get_endpoint(Agent)
+@get_endpoint(Agent, stream=True)
 async def get_agents(request, agents, user):
     pass
 
@@ -1004,7 +1009,7 @@ async def bulk_delete_agents(request, user: User):
 
 @agent_software.get("/all")
 @protected({UserRole.Role.ADMIN})
-@get_endpoint(AgentSoftware)
+@get_endpoint(AgentSoftware, stream=True)
 async def get_agent_software(request, software, user):
     pass
 
@@ -1020,19 +1025,24 @@ async def get_agent_software_count(request, user):
 @agent_software.get("/")
 @protected()
 async def get_own_agent_software(request, user):
-    softwares = await AgentSoftware.filter(agent__user=user).all()
+    softwares = await AgentSoftware.filter(agent__user=user).select_related(
+        "service_plan__service_offering__service", "agent")
+    latest_versions = await latest_version_index.get_many(
+        (software.service_plan.service_offering.service_id, software.agent.operating_system_id)
+        for software in softwares)
     data = []
     for software in softwares:
-        offering = await (await software.service_plan).service_offering
-        service = await offering.service
-        agent = await software.agent
+        offering = software.service_plan.service_offering
+        service = offering.service
+        agent = software.agent
         data.append(
             {
-                **await software.to_dict(),
-                "latest_version": await get_latest_version(service, await agent.operating_system),
-                "offering": await offering.to_dict(),
-                "service": await service.to_dict(),
-                "agent": await agent.to_dict()
+                **await software.to_dict(verify_foreign_keys=False),
+                "latest_version": latest_versions.get(
+                    (str(service.id), str(agent.operating_system_id))),
+                "offering": await offering.to_dict(verify_foreign_keys=False),
+                "service": await service.to_dict(verify_foreign_keys=False),
+                "agent": await agent.to_dict(verify_foreign_keys=False)
             })
     return json(data)
 
@@ -1061,45 +1071,41 @@ async def create_agent_software(request, user):
 @protected()
 async def bulk_create_agent_software(request, user):
     missing_params = BadRequest("Missing parameters. Required: agents, service_plan.")
-    agents = []
     if request.json is None:
         raise missing_params
     try:
-        plan = await ServicePlan.get_or_none(id=request.json["service_plan"])
+        plan = await ServicePlan.filter(id=request.json["service_plan"]).select_related(
+            "service_offering__service").first()
         if plan is None:
             raise NotFound("Service plan not found.")
-        offering: ServiceOffering = await plan.service_offering
-        service: Service = await offering.service
-        offerings = await ServiceOffering.filter(service=service).all()
-        offering_ids = list(map(lambda offering: offering.id, offerings))
-        existing_plans = list(map(lambda plan: plan.id, await ServicePlan.filter(user=user,
-                                                                                 service_offering_id__in=offering_ids).all()))
-        existing_softwares = await AgentSoftware.filter(
-            service_plan_id__in=existing_plans).all().prefetch_related("agent")
-        if (await plan.user).id != user.id:
+        if plan.user_id != user.id:
             raise BadRequest(
                 "You can't bulk-create agent software for another user's service plan.")
-        agent_ids = request.json.get("agents", [])
+        service: Service = plan.service_offering.service
+        agent_ids = list(dict.fromkeys(map(str, request.json.get("agents", []))))
+        agents_by_id = {str(agent.id): agent for agent in await Agent.filter(id__in=agent_ids)}
+        installed_agent_ids = set(map(str, await AgentSoftware.filter(
+            service_plan__user=user,
+            service_plan__service_offering__service_id=service.id
+        ).values_list("agent_id", flat=True)))
+        agents = []
         for id in agent_ids:
-            agent = await Agent.get_or_none(id=id)
+            agent = agents_by_id.get(id)
             if agent is None:
                 raise NotFound(f"Agent {id} not found.")
-            if (await agent.user).id != user.id:
+            if agent.user_id != user.id:
                 raise BadRequest("You can't bulk-create agent software for other user's agents.")
-            for software in existing_softwares:
-                potentially_already_installed_agent = await software.agent
-                if str(potentially_already_installed_agent.id) == id:
-                    raise BadRequest(
-                        f"The software you want to install via the service plan is already installed on agent {id} (possibly by another service plan).")
+            if id in installed_agent_ids:
+                raise BadRequest(
+                    f"The software you want to install via the service plan is already installed on agent {id} (possibly by another service plan).")
             agents.append(agent)
         softwares = [AgentSoftware(agent=agent, service_plan=plan, installing=True) for agent in
                      agents]
         await AgentSoftware.bulk_create(softwares)
-        for (software, agent) in zip(softwares, agents):
-            await send_agent_software_notification(EventType.INSTALL_SOFTWARE, agent,
-                                                   service, software)
-        await _increase_download_count_for_service(str(service.id), len(agent_ids))
-        return HTTPResponse(status=201)
+        delivery = await send_bulk_agent_software_notifications(EventType.INSTALL_SOFTWARE,
+                                                                service, zip(softwares, agents))
+        await _increase_download_count_for_service(str(service.id), len(agents))
+        return json(delivery, status=201)
     except KeyError:
         raise missing_params
     except IntegrityError:
@@ -1122,8 +1128,8 @@ async def delete_agent_software(request: Request, user: User):
         raise NotFound(f"AgentSoftware '{id}' not found.")
     if str((await (await software.agent).user).id) != str(user.id):
         raise BadRequest("You can only dismiss software on your own agents.")
-    recipient = Recipient(SubscriberType.AGENT, str((await software.agent).id))
-    cancel_event(EventType.INSTALL_SOFTWARE, recipient)
+    recipient = Recipient(SubscriberType.AGENT, str(software.agent_id))
+    cancel_event(recipient, str(software.id))
     await software.delete()
     return HTTPResponse(status=204)
 
@@ -1170,18 +1176,43 @@ async def perform_software_uninstallation(agent: Agent, service: Service, softwa
 async def send_agent_software_notification(command: EventType, agent: Agent,
                                            service: Service,
                                            software: AgentSoftware):
+    await send_bulk_agent_software_notifications(command, service, [(software, agent)])
+
+
+async def send_bulk_agent_software_notifications(
+        command: EventType, service: Service,
+        softwares_and_agents: Iterable[Tuple[AgentSoftware, Agent]]) -> Dict[str, int]:
+    """Queue the command for every agent, resolving the version once per operating system.
+    Returns how many commands can be delivered right away and how many wait for their agent to
+    connect."""
     assert command in [EventType.INSTALL_SOFTWARE, EventType.UNINSTALL_SOFTWARE]
-    software.last_updated = datetime.datetime.now(tz=datetime.timezone.utc)
-    # await software.save()
-    msg = {
-        "service": service.system_name,
-        "software": str(software.id)
-    }
-    if command == EventType.INSTALL_SOFTWARE:
-        msg["version"] = await get_latest_version(service, await agent.operating_system)
-    recipient = Recipient(SubscriberType.AGENT, str(agent.id))
-    event = Event(command, recipient, msg, False)
-    notify.queue(event)
+    softwares_and_agents = list(softwares_and_agents)
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    versions = {}
+    events = []
+    for software, agent in softwares_and_agents:
+        software.last_updated = now
+        msg = {
+            "service": service.system_name,
+            "software": str(software.id)
+        }
+        if command == EventType.INSTALL_SOFTWARE:
+            os_id = agent.operating_system_id
+            if os_id not in versions:
+                versions[os_id] = await latest_version_index.get(service.id, os_id)
+            msg["version"] = versions[os_id]
+            sha256 = None if msg["version"] is None else \
+                playbook_manifest.sha256(service.system_name, msg["version"])
+        else:
+            sha256 = playbook_manifest.uninstall_sha256(service.system_name)
+        if sha256 is not None:
+            msg["sha256"] = sha256
+        recipient = Recipient(SubscriberType.AGENT, str(agent.id))
+        events.append(Event(command, recipient, msg, False, str(software.id)))
+    await notify.queue_durable(events)
+    # The hub might run in another process, the connection state is shared through the database
+    dispatched = sum(1 for _, agent in softwares_and_agents if agent.connected)
+    return {"dispatched": dispatched, "deferred": len(events) - dispatched}
 
 
 @license.get("/")
@@ -1213,7 +1244,7 @@ async def update_license(request, license, user):
 @protected({UserRole.Role.ADMIN})
 @delete_endpoint(License)
 async def delete_license(request, license, user):
-    pass
+    notify.invalidate_cache("catalog")
 
 
 @operating_system.get("/")
@@ -1246,7 +1277,8 @@ async def update_operating_system(request, user, operating_system):
 @protected({UserRole.Role.ADMIN})
 @delete_endpoint(OperatingSystem)
 async def delete_operating_system(request, user, operating_system):
-    pass
+    notify.invalidate_cache("catalog")
+    notify.invalidate_cache("latest_versions")
 
 
 @agent.get("/count")
@@ -1306,6 +1338,15 @@ async def get_server_stati(request, user, stati):
     pass
 
 
+@app.get("/api/server/notify/latency")
+@protected({UserRole.Role.ADMIN})
+async def get_notify_latency(request, user):
+    try:
+        return json(await notify.get_delivery_latency())
+    except TimeoutError:
+        return text("The notify gateway didn't respond.", status=503)
+
+
 @app.post("/api/server/stop")
 @protected({UserRole.Role.ADMIN})
 async def stop_server(request, user):
@@ -1575,6 +1616,8 @@ async def delete_available_versions_bulk(request: Request, user):
     except (NameError, AttributeError):
         raise BadRequest("Missing ids parameter.")
     await PackageManagerAvailableVersion.filter(id__in=ids).delete()
+    notify.invalidate_cache("catalog")
+    notify.invalidate_cache("latest_versions")
     return HTTPResponse(status=204)
 
 
@@ -1588,14 +1631,22 @@ async def server_status(request, stati, user):
 async def _increase_download_count_for_service(id: str, count: int = None):
     cnt = count if count is not None else 1
     await Service.filter(id=id).update(download_count=F("download_count") + cnt)
+    notify.invalidate_cache("catalog")
 
 
-app.add_task(run_schedules())
-app.add_task(perform_billing_maintenance())
 app.add_task(set_up_sigint_handler())
-app.add_task(notify.run_websocket_server())
-app.add_task(notify.run_queue_worker())
-app.add_task(notify.run_event_worker())
+app.add_task(playbook_manifest.run())
+if NOTIFY_GATEWAY == "external":
+    event_bus = UnixSocketBus(NOTIFY_BUS_PATH, hub=False)
+elif NOTIFY_BUS_PATH is not None:
+    event_bus = UnixSocketBus(NOTIFY_BUS_PATH)
+else:
+    event_bus = InProcessBus()
+notify.set_bus(event_bus)
+# Shared through the bus, so that writes handled by one worker invalidate them in all of them
+notify.register_cache("catalog", catalog_cache.invalidate)
+notify.register_cache("latest_versions", latest_version_index.invalidate)
+app.add_task(event_bus.run(lambda: notify.run_hub(NOTIFY_DISPATCH_TASKS)))
 
 if __name__ == "__main__":
-    app.run("0.0.0.0")
+    app.run("0.0.0.0", workers=SERVER_WORKERS)